@@ -0,0 +1,358 @@
+"""End-to-end benchmark of the Zity MQTT bridge against the simulator.
+
+Starts the Zity simulator and MQTT broker stand-in from zity_simulator.py, runs the
+bridge against them in a subprocess and reports:
+
+* poll cycle duration and Modbus transactions per cycle, measured on the simulated bus
+* CPU time used by the bridge per poll cycle
+* latency from each set_* command to its state topic, and to the register write on
+  the bus
+
+    python zity-benchmark.py [--config zity_config.yaml] [--duration 60] [--json results.json]
+
+Runs on any Linux box; no controller or broker is needed. With --replay, it replays a
+capture recorded by the bridge (see zity_capture.py) instead, and reports the CPU time
+and MQTT traffic of the bridge for that real-world traffic.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+import zity_capture
+import zity_simulator
+
+BRIDGE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zity-mqtt-bridge.py")
+
+# Transactions more than this many seconds apart belong to different poll cycles.
+CYCLE_GAP = 1.0
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process, from /proc"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(values, scale=1000):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": round(statistics.mean(values) * scale, 1),
+        "p50": round(percentile(values, 0.5) * scale, 1),
+        "max": round(max(values) * scale, 1)
+    }
+
+class Benchmark:
+    def __init__(self, args):
+        with open(args.config, "r") as f:
+            self.config = yaml.safe_load(f)
+        self.args = args
+        self.base_topic = self.config["mqtt"]["base_topic"]
+        self.loop = asyncio.new_event_loop()
+        self.zity = zity_simulator.Zity(
+            self.config, args.baudrate, args.propagation_delay, args.trigger_settle, temp_drift=args.temp_drift
+        )
+        self.broker = zity_simulator.Broker()
+        self.transactions = []
+        self.messages = []
+        self.writes = []
+        self.zity.transaction_listeners.append(lambda at, frame, duration: self.transactions.append((at, duration)))
+        self.zity.listeners.append(lambda register, value: self.writes.append((time.monotonic(), register, value)))
+        self.broker.listeners.append(lambda topic, payload: self.messages.append((time.monotonic(), topic, payload)))
+
+    def start_simulator(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.mqtt_port = self.loop.run_until_complete(self.broker.start())
+            self.pty = zity_simulator.serve_pty(self.zity, self.loop)
+            if self.args.transport != "serial":
+                framing = "tcp" if self.args.transport == "tcp" else "rtu"
+                self.gateway_port = self.loop.run_until_complete(zity_simulator.serve_tcp(self.zity, framing=framing))
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+    def start_bridge(self):
+        config = dict(self.config)
+        config["mqtt"] = dict(config["mqtt"], broker="127.0.0.1", port=self.mqtt_port)
+        config["loglevel"] = "ERROR"
+        config["runtime"] = self.args.runtime
+        if self.args.replay:
+            self.start_replay(config)
+            return
+        if self.args.capture:
+            config["capture"] = {"file": os.path.abspath(self.args.capture)}
+        if self.args.transport == "serial":
+            config["modbus"] = dict(config["modbus"], port=self.pty)
+        else:
+            config["modbus"] = dict(
+                config["modbus"], transport=self.args.transport, host="127.0.0.1", port=self.gateway_port,
+                pipeline=self.args.pipeline
+            )
+        if self.args.baudrate:
+            config["modbus"]["baudrate"] = self.args.baudrate
+        if self.args.settle:
+            config["trigger_settle"] = dict(config.get("trigger_settle") or {}, strategy=self.args.settle)
+        if self.args.state_format:
+            config["publishing"] = dict(config.get("publishing") or {}, state_format=self.args.state_format)
+        # Poll everything at the same interval, so every poll is a full cycle.
+        interval = self.args.interval
+        config["polling"] = dict(
+            config.get("polling", {}),
+            intervals={"zone_temps": interval, "zone_settings": interval, "system": interval, "alarms": interval},
+            max_backoff=1,
+            stats_interval=interval
+        )
+        self.launch_bridge(config)
+
+    def start_replay(self, config):
+        speed = self.args.speed
+        config["capture"] = {"replay": os.path.abspath(self.args.replay), "speed": speed}
+        # The bridge schedules its polls on the wall clock; scale them to the replay.
+        polling = dict(config.get("polling", {}))
+        intervals = {"zone_temps": 30, "zone_settings": 30, "system": 60, "alarms": 300}
+        intervals.update(polling.get("intervals", {}))
+        polling["intervals"] = {name: interval / speed for name, interval in intervals.items()}
+        polling["readback_interval"] = polling.get("readback_interval", 1) / speed
+        polling["stats_interval"] = polling.get("stats_interval", 60) / speed
+        commands = dict(config.get("commands", {}))
+        commands["coalesce_window"] = commands.get("coalesce_window", 0.3) / speed
+        commands["confirm_timeout"] = commands.get("confirm_timeout", 30) / speed
+        config["polling"], config["commands"] = polling, commands
+        self.launch_bridge(config)
+
+    def launch_bridge(self, config):
+        self.workdir = tempfile.mkdtemp(prefix="zity-benchmark-")
+        with open(os.path.join(self.workdir, "zity_config.yaml"), "w") as f:
+            yaml.safe_dump(config, f)
+        self.log = open(os.path.join(self.workdir, "bridge.log"), "w")
+        self.bridge = subprocess.Popen(
+            [sys.executable, self.args.bridge], cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+    def wait_for(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            if self.bridge.poll() is not None:
+                raise RuntimeError(f"Bridge exited; see {self.log.name}")
+            time.sleep(0.01)
+        return False
+
+    def publish(self, topic, payload):
+        self.loop.call_soon_threadsafe(self.broker.deliver, topic, payload.encode(), 0)
+
+    def measure_polling(self):
+        """Let the bridge poll for the configured duration and split the bus traffic into cycles"""
+        # Wait for the first poll, then for a quiet moment, so we start on a cycle boundary.
+        if not self.wait_for(lambda: self.transactions, 60):
+            raise RuntimeError("The bridge did not start polling")
+        self.wait_for(lambda: time.monotonic() - self.transactions[-1][0] > CYCLE_GAP, 60)
+
+        started = time.monotonic()
+        first = len(self.transactions)
+        cpu_started = cpu_seconds(self.bridge.pid)
+        time.sleep(self.args.duration)
+        # Don't cut the last cycle in half.
+        self.wait_for(lambda: time.monotonic() - self.transactions[-1][0] > CYCLE_GAP, 30)
+        cpu_used = cpu_seconds(self.bridge.pid) - cpu_started
+
+        cycles = []
+        for transaction in self.transactions[first:]:
+            if cycles and transaction[0] - cycles[-1][-1][0] <= CYCLE_GAP:
+                cycles[-1].append(transaction)
+            else:
+                cycles.append([transaction])
+        # A cycle runs from its first request until the last response is on the wire.
+        durations = [cycle[-1][0] + cycle[-1][1] - cycle[0][0] for cycle in cycles]
+        return {
+            "cycles": len(cycles),
+            "window_seconds": round(time.monotonic() - started, 1),
+            "cycle_duration_ms": summarize(durations),
+            "transactions_per_cycle": round(statistics.mean(len(cycle) for cycle in cycles), 1) if cycles else None,
+            "cpu_ms_per_cycle": round(cpu_used * 1000 / len(cycles), 1) if cycles else None
+        }
+
+    def command_cases(self):
+        zone_id = next(iter(self.config["zones"]))
+        zone = self.config["zones"][zone_id]
+        system = self.config["system_registers"]
+        zone_topic = f"{self.base_topic}/zone/{zone_id}"
+        system_topic = f"{self.base_topic}/system"
+        scenes = [
+            json.dumps({zid: {"setpoint": setpoint, "preset_mode": preset} for zid in self.config["zones"]})
+            for setpoint, preset in ((19.0, "eco"), (21.5, "none"))
+        ]
+        last_zone = list(self.config["zones"])[-1]
+        # (command topic, payloads to alternate between, state topic, register written)
+        return [
+            (f"{zone_topic}/set_temp", ["19.5", "21.0"], f"{zone_topic}/setpoint", zone["setpoint_write_register"]),
+            (f"{zone_topic}/set_mode", ["off", "cool"], f"{zone_topic}/mode", zone["status_write_register"]),
+            (f"{zone_topic}/set_fan_mode", ["low", "high"], f"{zone_topic}/fan_mode", zone["fan_mode_write_register"]),
+            (f"{zone_topic}/set_preset_mode", ["eco", "none"], f"{zone_topic}/preset_mode", zone["preset_mode_write_register"]),
+            (f"{system_topic}/set_mode", ["heat", "cool"], f"{system_topic}/mode", system["mode_write"]),
+            (f"{system_topic}/set_power", ["off", "on"], f"{system_topic}/power_mode", system["power_mode_write"]),
+            # Every zone at once; the last zone's setpoint is the last state published.
+            (f"{self.base_topic}/scene/set", scenes, f"{self.base_topic}/zone/{last_zone}/setpoint",
+             self.config["zones"][last_zone]["setpoint_write_register"])
+        ]
+
+    def measure_commands(self):
+        results = {}
+        for topic, payloads, state_topic, register in self.command_cases():
+            if self.args.state_format == "json":
+                # Any update of the zone's or the system's state document.
+                state_topic = state_topic.rsplit("/", 1)[0] + "/state"
+            state_latencies = []
+            write_latencies = []
+            for repeat in range(self.args.repeats):
+                payload = payloads[repeat % len(payloads)]
+                messages, writes = len(self.messages), len(self.writes)
+                sent = time.monotonic()
+                self.publish(topic, payload)
+                got_state = self.wait_for(
+                    lambda: any(m[1] == state_topic for m in self.messages[messages:]), self.args.command_timeout
+                )
+                got_write = self.wait_for(
+                    lambda: any(w[1] == register for w in self.writes[writes:]), self.args.command_timeout
+                )
+                if got_state:
+                    state_latencies.append(next(m[0] for m in self.messages[messages:] if m[1] == state_topic) - sent)
+                if got_write:
+                    write_latencies.append(next(w[0] for w in self.writes[writes:] if w[1] == register) - sent)
+                time.sleep(self.args.command_spacing)
+            results[topic.split("/", 1)[1]] = {
+                "state_topic_ms": summarize(state_latencies),
+                "bus_write_ms": summarize(write_latencies),
+                "timeouts": self.args.repeats - min(len(state_latencies), len(write_latencies))
+            }
+        return results
+
+    def measure_replay(self):
+        """Wait for the bridge to finish the replay and report what it cost"""
+        replay = zity_capture.Replay.load(self.args.replay, self.args.speed)
+        started = time.monotonic()
+        deadline = started + (replay.end - replay.start) / self.args.speed + 60
+        while True:
+            pid, status, usage = os.wait4(self.bridge.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                self.bridge.kill()
+                raise RuntimeError(f"The replay did not finish; see {self.log.name}")
+            time.sleep(0.1)
+        self.bridge.returncode = os.waitstatus_to_exitcode(status)
+        capture_seconds = replay.end - replay.start
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+        stats = [payload for _, topic, payload in self.messages if topic.endswith("/bridge/stats")]
+        return {
+            "capture_seconds": round(capture_seconds, 1),
+            "wall_seconds": round(time.monotonic() - started, 1),
+            "speed": self.args.speed,
+            "commands": len(replay.messages),
+            "cpu_seconds": round(cpu_seconds, 2),
+            "cpu_ms_per_capture_minute": round(cpu_seconds * 60000 / capture_seconds, 1) if capture_seconds else None,
+            "mqtt_publishes": sum(1 for _, topic, _ in self.messages if not topic.endswith("/bridge/stats")),
+            "bridge_stats": json.loads(stats[-1]) if stats else None
+        }
+
+    def run(self):
+        self.start_simulator()
+        self.start_bridge()
+        if self.args.replay:
+            results = {"replay": self.measure_replay(), "broker": dict(self.broker.stats)}
+            return results
+        try:
+            results = {"polling": self.measure_polling(), "commands": self.measure_commands()}
+        finally:
+            self.bridge.terminate()
+            self.bridge.wait()
+        results["simulator"] = dict(self.zity.stats)
+        results["broker"] = dict(self.broker.stats)
+        return results
+
+def print_replay_results(results):
+    replay = dict(results["replay"])
+    stats = replay.pop("bridge_stats") or {}
+    for key, value in replay.items():
+        print(f"{key + ':':<27}{value}")
+    for key in ("bus_occupancy", "poll_groups", "failing_registers", "trigger_settle"):
+        if key in stats:
+            print(f"{key + ':':<27}{stats[key]}")
+    print(f"Broker:    {results['broker']}")
+
+def print_results(results):
+    if "replay" in results:
+        print_replay_results(results)
+        return
+    polling = results["polling"]
+    print(f"Poll cycles:              {polling['cycles']} in {polling['window_seconds']} s")
+    print(f"Cycle duration (ms):      {polling['cycle_duration_ms']}")
+    print(f"Transactions per cycle:   {polling['transactions_per_cycle']}")
+    print(f"CPU time per cycle (ms):  {polling['cpu_ms_per_cycle']}")
+    print()
+    print(f"{'Command':<28} {'state p50':>10} {'state max':>10} {'write p50':>10} {'write max':>10} {'timeouts':>9}")
+    for topic, result in results["commands"].items():
+        state = result["state_topic_ms"] or {}
+        write = result["bus_write_ms"] or {}
+        print(
+            f"{topic:<28} {state.get('p50', '-'):>10} {state.get('max', '-'):>10} "
+            f"{write.get('p50', '-'):>10} {write.get('max', '-'):>10} {result['timeouts']:>9}"
+        )
+    print()
+    print(f"Simulator: {results['simulator']}")
+    print(f"Broker:    {results['broker']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Zity MQTT bridge against the simulator")
+    parser.add_argument("--config", default="zity_config.yaml")
+    parser.add_argument("--bridge", default=BRIDGE_SCRIPT)
+    parser.add_argument("--runtime", default="threaded", choices=["threaded", "asyncio"])
+    parser.add_argument("--transport", default="serial", choices=["serial", "tcp", "rtu_over_tcp"],
+                        help="reach the simulator through a pty or a simulated gateway")
+    parser.add_argument("--pipeline", type=int, default=1, help="Modbus TCP requests in flight (asyncio only)")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of polling to measure")
+    parser.add_argument("--interval", type=float, default=10, help="poll interval for all register groups")
+    parser.add_argument("--baudrate", type=int, help="defaults to the baudrate in the config")
+    parser.add_argument("--propagation-delay", type=float, default=1.0)
+    parser.add_argument("--trigger-settle", type=float, default=0.0)
+    parser.add_argument("--settle", choices=["fixed", "readback", "adaptive"],
+                        help="trigger settle strategy of the bridge; defaults to the config")
+    parser.add_argument("--state-format", choices=["topics", "json", "both"],
+                        help="how the bridge publishes states; defaults to the config")
+    parser.add_argument("--temp-drift", type=float, default=0.05)
+    parser.add_argument("--repeats", type=int, default=4, help="times to send each command")
+    parser.add_argument("--command-spacing", type=float, default=1.0)
+    parser.add_argument("--command-timeout", type=float, default=10.0)
+    parser.add_argument("--capture", help="let the bridge record its Modbus traffic and commands to this file")
+    parser.add_argument("--replay", help="replay this capture instead of running the simulator")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = Benchmark(args).run()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
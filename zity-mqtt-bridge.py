@@ -1,30 +1,148 @@
 import yaml
+import sys
 import time
 import json
+import hashlib
+import os
 import threading
 import logging
+import queue
+import itertools
+import asyncio
+import argparse
+import http.server
+from concurrent.futures import Future
+from collections import OrderedDict
 import paho.mqtt.client as mqtt
 from pymodbus.client.serial import ModbusSerialClient
+from pymodbus.client import AsyncModbusSerialClient, ModbusTcpClient, AsyncModbusTcpClient
+from pymodbus.framer import ModbusRtuFramer, ModbusSocketFramer
+from pymodbus.exceptions import ConnectionException
+
+# ------------------ Metrics ------------------ #
+
+# A small registry of counters and histograms, served in the Prometheus text format
+# when metrics.port is configured. Metrics are identified by their name and a tuple of
+# (label, value) pairs.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+METRICS = {
+    "zity_modbus_request_seconds": ("histogram", "Modbus transaction duration"),
+    "zity_modbus_errors_total": ("counter", "Failed Modbus transactions per register"),
+    "zity_poll_duration_seconds": ("histogram", "Duration of the reads of a poll"),
+    "zity_lock_wait_seconds": ("histogram", "Time spent waiting to acquire a lock"),
+    "zity_command_wait_seconds": ("histogram", "Time commands waited in the bus queue"),
+    "zity_command_exec_seconds": ("histogram", "Time spent executing commands"),
+    "zity_flush_wait_seconds": ("histogram", "Time write batches waited in the bus queue"),
+    "zity_flush_exec_seconds": ("histogram", "Time spent sending write batches"),
+    "zity_write_latency_seconds": ("histogram", "Time from staging a write until its batch was sent"),
+    "zity_mqtt_publishes_total": ("counter", "MQTT messages handed to the client"),
+    "zity_mqtt_published_total": ("counter", "MQTT messages written to the broker"),
+    "zity_mqtt_inflight": ("gauge", "MQTT messages handed to the client but not written yet"),
+    "zity_mqtt_queue_depth": ("gauge", "Topics waiting in the outbound queue"),
+    "zity_mqtt_dropped_total": ("counter", "Messages dropped because the outbound queue was full"),
+    "zity_bus_queue_depth": ("gauge", "Jobs waiting for the Modbus bus"),
+    "zity_bus_busy_seconds_total": ("counter", "Time the Modbus bus was busy"),
+    "zity_trigger_settle_seconds": ("histogram", "Time between a trigger write and the writes that took effect"),
+    "zity_write_confirm_seconds": ("histogram", "Time from a command until the controller reported the new value"),
+    "zity_register_trips_total": ("counter", "Times a register's circuit breaker tripped"),
+    "zity_registers_tripped": ("gauge", "Registers currently skipped because they keep failing"),
+    "zity_commands_rejected_total": ("counter", "MQTT commands ignored because of an invalid payload")
+}
+
+metrics_lock = threading.Lock()
+metric_values = {}
+metric_gauges = {}
+
+def inc_counter(name, labels=(), amount=1):
+    with metrics_lock:
+        metric_values[(name, labels)] = metric_values.get((name, labels), 0) + amount
+
+def observe(name, value, labels=()):
+    with metrics_lock:
+        histogram = metric_values.get((name, labels))
+        if histogram is None:
+            histogram = metric_values[(name, labels)] = [0] * len(LATENCY_BUCKETS) + [0, 0.0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+def render_metrics():
+    """Return all metrics in the Prometheus text exposition format"""
+    def label_text(labels, extra=()):
+        labels = labels + extra
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    with metrics_lock:
+        values = sorted(metric_values.items())
+    values += [((name, ()), gauge()) for name, gauge in metric_gauges.items()]
+    lines = []
+    for metric, (metric_type, description) in METRICS.items():
+        samples = [(labels, value) for (name, labels), value in values if name == metric]
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for labels, value in samples:
+            if metric_type != "histogram":
+                lines.append(f"{metric}{label_text(labels)} {value}")
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                lines.append(f"{metric}_bucket{label_text(labels, (('le', bound),))} {count}")
+            lines.append(f"{metric}_bucket{label_text(labels, (('le', '+Inf'),))} {value[-2]}")
+            lines.append(f"{metric}_count{label_text(labels)} {value[-2]}")
+            lines.append(f"{metric}_sum{label_text(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+def start_metrics_server(port):
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+
+class TimedLock:
+    """A lock that records how long it took to acquire it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        started = time.monotonic()
+        self.lock.acquire()
+        observe("zity_lock_wait_seconds", time.monotonic() - started, (("lock", self.name),))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
 
 # ------------------ Lock ----------------------#
-state_lock = threading.Lock()
+# Only guards swapping zone state records; never held during bus or network I/O.
+state_lock = TimedLock("state")
 
 # ------------------ Load Config ------------------ #
 with open("zity_config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
 base_topic = config["mqtt"]["base_topic"]
-zones = config["zones"]
-trigger_register = config["trigger_register"]
-system_registers = config["system_registers"]
-alarm_registers = {int(k): v for k, v in config["alarm_registers"].items()}
-system_mode_write_register = system_registers["mode_write"]
-system_power_mode_write_register = system_registers["power_mode_write"]
-slave_id = config["modbus"]["slave_id"]
-overall_status_register = system_registers["mode"]
-master_zone = config["master_zone"]
 loglevel = config["loglevel"]
-latency = config["latency"]
+runtime = config.get("runtime", "threaded")
 
 # ------------------ Logging Setup ------------------ #
 logging.basicConfig(
@@ -35,31 +153,285 @@ logger = logging.getLogger(__name__)
 logging.getLogger().setLevel(loglevel.upper())
 
 # ------------------ Manual Override State ------------------ #
-manual_override_states = {zone_id: False for zone_id in zones}
-last_mqtt_values = {
-    zone_id: {
-        'reset': False,
-        'postpone': 0,
-        'temp': None,
-        'mode': None,
-        'fan_mode': None,
-        'preset_mode': None
-    } for zone_id in zones
+class ZoneState:
+    """Immutable record of the manual override state and last MQTT values of a zone.
+
+    Records are never changed in place. Readers just take the current record from
+    the zone_states of their controller without locking; writers build a new one and
+    swap it in with update_zone_state(). The same goes for the pending dict, which
+    holds the writes that wait for confirmation per field.
+    """
+    __slots__ = ("manual_override", "reset", "pending", "temp", "mode", "fan_mode", "preset_mode")
+
+    def __init__(self, manual_override=False, reset=False, pending=None, temp=None, mode=None, fan_mode=None, preset_mode=None):
+        if pending is None:
+            pending = {}
+        for name, value in zip(self.__slots__, (manual_override, reset, pending, temp, mode, fan_mode, preset_mode)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"ZoneState is immutable; use replace() to change {name}")
+
+    def replace(self, **changes):
+        """Return a copy of this record with some fields changed"""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return ZoneState(**values)
+
+    def __repr__(self):
+        return "ZoneState(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")"
+
+def update_zone_state(ctl, zone_id, **changes):
+    """Atomically swap in a new state record for a zone, with some fields changed"""
+    with state_lock:
+        state = ctl.zone_states[zone_id].replace(**changes)
+        ctl.zone_states[zone_id] = state
+    return state
+
+# ------------------ Controllers and buses ------------------ #
+
+# The bridge can serve several Zity controllers. Each controller has its own slave ID,
+# zones, registers and topic prefix. Controllers on the same serial port share a Bus,
+# which owns the Modbus client and the job queue of that port's worker. Controllers
+# behind the same TCP gateway share a Bus as well. Without a controllers list, the
+# top-level settings describe a single controller, published under the MQTT base topic
+# as before.
+CONTROLLER_KEYS = ("zones", "trigger_register", "master_zone", "system_registers", "alarm_registers")
+
+# The transport of a bus is selected with "transport" in its modbus section: "serial"
+# (the default) for a local RS485 port, "tcp" for a Modbus TCP gateway and
+# "rtu_over_tcp" for gateways that pass RTU frames through a TCP socket. TCP connections
+# are opened once and reused. Every transport has its own default response timeout and
+# number of retries, which the timeout and retries settings override.
+TRANSPORT_DEFAULTS = {
+    "serial": {"timeout": 1, "retries": 3},
+    "tcp": {"timeout": 0.5, "retries": 1},
+    "rtu_over_tcp": {"timeout": 0.5, "retries": 1}
 }
-first_poll_completed = False
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 60
+
+def bus_name(modbus_config):
+    """The name of the bus a modbus section describes: the serial port or the gateway address"""
+    if modbus_config.get("transport", "serial") == "serial":
+        return modbus_config["port"]
+    return f"{modbus_config['host']}:{modbus_config.get('port', 502)}"
+
+class Bus:
+    """A physical Modbus bus: one client, one job queue and one worker"""
+
+    def __init__(self, modbus_config):
+        self.config = modbus_config
+        self.name = bus_name(modbus_config)
+        self.transport = modbus_config.get("transport", "serial")
+        if self.transport not in TRANSPORT_DEFAULTS:
+            raise ValueError(f"Unknown Modbus transport {self.transport}")
+        # Modbus TCP matches responses to requests by transaction ID, so a gateway that
+        # queues requests can have several in flight. Only the asyncio runtime uses this.
+        self.pipeline = modbus_config.get("pipeline", 1) if self.transport == "tcp" else 1
+        self.client = None
+        self.queue = queue.PriorityQueue()
+        self.busy_time = 0.0
+        self.last_stats = (time.monotonic(), 0.0)
+        self.reconnect_delay = RECONNECT_DELAY_MIN
+        self.reconnect_at = 0.0
+        self.reconnect_lock = threading.Lock()
+        # Some controllers and RS485 adapters need a pause between a response and the
+        # next request, on top of the inter-frame gap of the Modbus framing.
+        self.request_delay = modbus_config.get("request_delay", 0)
+        self.last_request = 0.0
+
+    def request_gap(self):
+        """Seconds to wait before the next request may be sent"""
+        if not self.request_delay:
+            return 0.0
+        return max(0.0, self.last_request + self.request_delay - time.monotonic())
+
+    def reconnect_failed(self):
+        """Return how long to wait before the next connection attempt.
+
+        The delay doubles with every failed attempt on the bus. The pollers of the other
+        controllers on the bus that fail while it runs just wait for the same moment.
+        """
+        now = time.monotonic()
+        with self.reconnect_lock:
+            if now >= self.reconnect_at:
+                self.reconnect_at = now + self.reconnect_delay
+                self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_DELAY_MAX)
+            return self.reconnect_at - now
+
+    def reconnected(self):
+        with self.reconnect_lock:
+            self.reconnect_delay = RECONNECT_DELAY_MIN
+            self.reconnect_at = 0.0
+
+# The controller only accepts register writes some time after a write to the trigger
+# register. How the bridge waits for that is set per controller with trigger_settle:
+#   fixed     wait delay seconds and write (the default, 0.2 s)
+#   readback  write after min_delay, read the registers back and write them again
+#             every poll_interval until they hold the new values
+#   adaptive  wait a learned delay, write and read the registers back. When the writes
+#             did not take effect, the delay doubles and they are written again. Every
+#             success lowers the delay a little, but never below the longest delay that
+#             failed times margin.
+# Both checking strategies give up after max_delay. The settle times are reported per
+# controller in bridge/stats.
+SETTLE_STRATEGIES = ("fixed", "readback", "adaptive")
+
+class TriggerSettle:
+    """The settle strategy of a controller and what it learned so far"""
+
+    def __init__(self, ctl, settings):
+        self.ctl = ctl
+        self.strategy = settings.get("strategy", "fixed")
+        if self.strategy not in SETTLE_STRATEGIES:
+            raise ValueError(f"Unknown trigger_settle strategy {self.strategy}")
+        self.verify = self.strategy != "fixed"
+        self.delay = settings.get("delay", 0.2)
+        self.min_delay = settings.get("min_delay", 0.0)
+        self.max_delay = settings.get("max_delay", 1.0)
+        self.poll_interval = settings.get("poll_interval", 0.02)
+        self.margin = settings.get("margin", 1.5)
+        self.failed_delay = 0.0
+        self.settles = 0
+        self.failures = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+    def first_delay(self):
+        return self.min_delay if self.strategy == "readback" else self.delay
+
+    def retry_delay(self, delay):
+        """Return the delay to try after writes did not take effect at delay, or None to give up"""
+        self.failures += 1
+        if delay >= self.max_delay:
+            return None
+        if self.strategy == "readback":
+            return min(self.max_delay, delay + self.poll_interval)
+        self.failed_delay = max(self.failed_delay, delay)
+        self.delay = min(self.max_delay, max(2 * delay, self.poll_interval))
+        return self.delay
+
+    def settled(self, waited):
+        """Record that writes took effect waited seconds after the trigger write"""
+        self.settles += 1
+        self.total += waited
+        self.longest = max(self.longest, waited)
+        observe("zity_trigger_settle_seconds", waited, (("controller", self.ctl.name),))
+        if self.strategy == "adaptive":
+            self.delay = max(self.min_delay, self.failed_delay * self.margin, 0.9 * self.delay)
+
+    def stats(self):
+        return {
+            "strategy": self.strategy,
+            "delay": round(self.first_delay(), 3),
+            "settles": self.settles,
+            "failures": self.failures,
+            "mean": round(self.total / self.settles, 3) if self.settles else None,
+            "max": round(self.longest, 3)
+        }
+
+class Controller:
+    """A Zity controller, its register map and the state the bridge keeps for it"""
+
+    def __init__(self, settings, bus):
+        self.name = settings["name"]
+        self.bus = bus
+        self.slave_id = settings["modbus"]["slave_id"]
+        self.base_topic = settings["base_topic"]
+        self.id_prefix = settings["id_prefix"]
+        self.device_name = settings["device_name"]
+        self.zones = settings["zones"]
+        self.trigger_register = settings["trigger_register"]
+        self.system_registers = settings["system_registers"]
+        self.alarm_registers = {int(k): v for k, v in settings["alarm_registers"].items()}
+        self.system_mode_write_register = self.system_registers["mode_write"]
+        self.system_power_mode_write_register = self.system_registers["power_mode_write"]
+        self.overall_status_register = self.system_registers["mode"]
+        self.master_zone = settings["master_zone"]
+        self.trigger_settle = TriggerSettle(self, settings["trigger_settle"])
+
+        self.zone_states = {zone_id: ZoneState() for zone_id in self.zones}
+        self.first_poll_completed = False
+        # Set up by the write coalescing, read planner, register cache and poll scheduler
+        # sections.
+        self.pending_writes = {}
+        self.flush_scheduled = False
+        self.batch_staged_at = None
+        self.config_registers = {
+            zone[key] for zone in self.zones.values() for key in ("master_slave_register", "fan_control_register")
+        }
+        self.config_written = {}
+        self.skipped_config = {}
+        self.poll_group_registers = None
+        self.poll_groups = None
+        self.register_values = {}
+        self.register_read_at = {}
+        self.written_read_registers = None
+        self.readbacks = {}
+        self.register_health = {}
+        self.poll_wakeup = threading.Event()
+
+def controller_settings():
+    """Return the settings of every configured controller"""
+    if "controllers" not in config:
+        settings = {key: config[key] for key in CONTROLLER_KEYS}
+        settings.update(
+            trigger_settle=config.get("trigger_settle", {}),
+            name="zity", modbus=config.get("modbus", {}), base_topic=base_topic, id_prefix="zity", device_name="Zity Controller"
+        )
+        return [settings]
+
+    # Every controller inherits the top-level settings it doesn't override.
+    result = []
+    for entry in config["controllers"]:
+        name = entry["name"]
+        settings = {key: entry.get(key, config.get(key)) for key in CONTROLLER_KEYS}
+        settings.update(
+            trigger_settle=entry.get("trigger_settle", config.get("trigger_settle", {})),
+            name=name,
+            modbus=dict(config.get("modbus", {}), **entry.get("modbus", {})),
+            base_topic=entry.get("base_topic", f"{base_topic}/{name}"),
+            id_prefix=f"zity_{name}",
+            device_name=f"Zity Controller {name}"
+        )
+        result.append(settings)
+    return result
+
+# Only the slave ID may differ between the controllers on a bus; the bus is set up with
+# the Modbus settings of the first controller on it.
+CONTROLLER_MODBUS_KEYS = ("slave_id",)
+
+buses = {}
+controllers = []
+for settings in controller_settings():
+    name = bus_name(settings["modbus"])
+    if name not in buses:
+        buses[name] = Bus(settings["modbus"])
+    differing = sorted(
+        key for key in set(settings["modbus"]) | set(buses[name].config)
+        if key not in CONTROLLER_MODBUS_KEYS and settings["modbus"].get(key) != buses[name].config.get(key)
+    )
+    if differing:
+        logger.warning(
+            f"Controller {settings['name']}: bus {name} uses the Modbus settings of the first controller on it; "
+            f"ignoring its own {', '.join(differing)}"
+        )
+    controllers.append(Controller(settings, buses[name]))
+logger.info(f"{len(controllers)} controller(s) on {len(buses)} bus(es)")
 
 # ----------------- MQTT Discovery device structures ----------- #
-ZONE_DEVICE_INFO = lambda zid, zname: {
-    "identifiers": [f"zity_zone_{zid}"],
+ZONE_DEVICE_INFO = lambda ctl, zid, zname: {
+    "identifiers": [f"{ctl.id_prefix}_zone_{zid}"],
     "name": f"Zity Zone {zname}",
     "manufacturer": "Madel",
     "model": "Zity 2.0",
-    "via_device": "zity_controller"
+    "via_device": f"{ctl.id_prefix}_controller"
 }
 
-SYSTEM_DEVICE_INFO = {
-    "identifiers": ["zity_controller"],
-    "name": "Zity Controller",
+SYSTEM_DEVICE_INFO = lambda ctl: {
+    "identifiers": [f"{ctl.id_prefix}_controller"],
+    "name": ctl.device_name,
     "manufacturer": "Madel",
     "model": "Zity 2.0"
 }
@@ -69,37 +441,1237 @@ state_list = ["off", "heat", "heat", "cool", "cool", "", "", "", "", "fan_only",
 fan_mode_list = ["auto", "low", "medium", "high"]
 system_fan_mode_list = ["off", "low", "medium", "high", "very high"]
 
+# ------------------ Capture and replay ------------------ #
+
+# With capture.file set, every Modbus request and response and every MQTT command the
+# bridge receives is appended to a compact binary capture file, which is rotated at
+# capture.max_bytes, keeping capture.backups old files. With capture.replay set instead,
+# the bridge replays a capture: the Modbus clients answer from the recorded traffic and
+# the recorded commands are fed to on_message at their original times, capture.speed
+# times faster. The bridge exits when the capture has been replayed. Both need
+# zity_capture.py next to the bridge. A replay publishes retained states and discovery
+# configs like a live bridge, so it only runs against a broker on this machine, such as
+# the benchmark's stand-in, unless capture.allow_remote_broker is set; the state file
+# is not used during a replay.
+capture_config = config.get("capture", {})
+capture_writer = None
+replay = None
+LOCAL_BROKERS = ("localhost", "127.0.0.1", "::1")
+if capture_config.get("replay"):
+    if config["mqtt"]["broker"] not in LOCAL_BROKERS and not capture_config.get("allow_remote_broker"):
+        raise ValueError(
+            f"Refusing to replay a capture to the broker at {config['mqtt']['broker']}; it would overwrite its "
+            f"retained states. Use a local broker, or set capture.allow_remote_broker."
+        )
+    import zity_capture
+    replay = zity_capture.Replay.load(capture_config["replay"], capture_config.get("speed", 1.0))
+    logger.info(
+        f"Replaying {capture_config['replay']}: {replay.end - replay.start:.0f} s of traffic "
+        f"and {len(replay.messages)} command(s) at {replay.speed}x"
+    )
+elif capture_config.get("file"):
+    import zity_capture
+    capture_writer = zity_capture.CaptureWriter(
+        capture_config["file"], capture_config.get("max_bytes", 10_000_000), capture_config.get("backups", 3)
+    )
+    logger.info(f"Capturing Modbus traffic and commands to {capture_config['file']}")
+
+class CapturedMessage:
+    """A recorded MQTT command, in the shape on_message expects"""
+    retain = False
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+def replay_commands():
+    """Feed the recorded commands to on_message at their capture times, then stop"""
+    replay.begin()
+    for at, topic, payload in replay.messages:
+        time.sleep(replay.wall_delay(at))
+        on_message(client, None, CapturedMessage(topic, payload))
+    time.sleep(replay.wall_delay(replay.end))
+    finish_replay()
+    # Give the network loop a moment to send the last stats.
+    time.sleep(1)
+    os._exit(0)
+
+async def async_replay_commands():
+    """Asyncio counterpart of replay_commands"""
+    replay.begin()
+    for at, topic, payload in replay.messages:
+        await asyncio.sleep(replay.wall_delay(at))
+        on_message(client, None, CapturedMessage(topic, payload))
+    await asyncio.sleep(replay.wall_delay(replay.end))
+    finish_replay()
+    await asyncio.sleep(1)
+    os._exit(0)
+
+def finish_replay():
+    logger.info("Replay finished")
+    publish_bridge_stats()
+
 # ------------------ Modbus client ------------------ #
-mb = ModbusSerialClient(
-    method=config["modbus"]["method"],
-    port=config["modbus"]["port"],
-    baudrate=config["modbus"]["baudrate"],
-    stopbits=config["modbus"]["stopbits"],
-    bytesize=config["modbus"]["bytesize"],
-    parity=config["modbus"]["parity"],
-    timeout=1
-)
+def create_modbus_client(bus, asynchronous=False):
+    if replay is not None:
+        return zity_capture.AsyncReplayClient(replay) if asynchronous else zity_capture.ReplayClient(replay)
+    modbus = bus.config
+    timeout = modbus.get("timeout", TRANSPORT_DEFAULTS[bus.transport]["timeout"])
+    retries = modbus.get("retries", TRANSPORT_DEFAULTS[bus.transport]["retries"])
+    if bus.transport == "serial":
+        client_class = AsyncModbusSerialClient if asynchronous else ModbusSerialClient
+        client = client_class(
+            method=modbus["method"],
+            port=modbus["port"],
+            baudrate=modbus["baudrate"],
+            stopbits=modbus["stopbits"],
+            bytesize=modbus["bytesize"],
+            parity=modbus["parity"],
+            timeout=timeout,
+            retries=retries
+        )
+    else:
+        client_class = AsyncModbusTcpClient if asynchronous else ModbusTcpClient
+        client = client_class(
+            modbus["host"],
+            port=modbus.get("port", 502),
+            framer=ModbusRtuFramer if bus.transport == "rtu_over_tcp" else ModbusSocketFramer,
+            timeout=timeout,
+            retries=retries,
+            reconnect_delay=RECONNECT_DELAY_MIN,
+            reconnect_delay_max=RECONNECT_DELAY_MAX
+        )
+    if capture_writer is not None:
+        recorder_class = zity_capture.AsyncRecordingClient if asynchronous else zity_capture.RecordingClient
+        client = recorder_class(client, capture_writer)
+    return client
+
+# The asyncio runtime uses the async flavour of the client, which has to be created on
+# the event loop. It replaces the clients when the loop starts.
+for bus in buses.values():
+    bus.client = None if runtime == "asyncio" else create_modbus_client(bus)
+
+# ------------------ Modbus bus worker ------------------ #
+
+# All Modbus traffic on a bus is executed by a single worker thread that owns it, so
+# separate buses are used in parallel. Jobs are taken from a priority queue, so
+# commands from MQTT, and then the batches of writes they staged, are executed before
+# the next poll transaction. Both are timed separately. Every controller has
+# its own poller, which waits for each read before queueing the next one; the reads of
+# controllers that share a bus therefore take turns. With the asyncio runtime, the
+# workers are tasks on the event loop and the queues are asyncio queues; see the asyncio
+# runtime section.
+COMMAND_PRIORITY = 0
+FLUSH_PRIORITY = 1
+POLL_PRIORITY = 2
+# The jobs that are timed: priority -> (stats counter, prefix of the stats and metrics)
+TIMED_JOBS = {COMMAND_PRIORITY: ("commands", "command"), FLUSH_PRIORITY: ("flushes", "flush")}
+
+event_loop = None
+bus_job_sequence = itertools.count()
+bus_stats_lock = threading.Lock()
+bus_stats = {
+    "commands": 0,
+    "command_wait_total": 0.0,
+    "command_wait_max": 0.0,
+    "command_exec_total": 0.0,
+    "command_exec_max": 0.0,
+    "flushes": 0,
+    "flush_wait_total": 0.0,
+    "flush_wait_max": 0.0,
+    "flush_exec_total": 0.0,
+    "flush_exec_max": 0.0,
+    "queue_depth_max": 0,
+    "busy_time": 0.0
+}
+
+def submit_bus_job(bus, priority, func, *args):
+    """Queue a job for the worker of a bus and return a Future for its result"""
+    future = Future()
+    job = (priority, next(bus_job_sequence), time.monotonic(), func, args, future)
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(bus.queue.put_nowait, job)
+    else:
+        bus.queue.put(job)
+    depth = bus.queue.qsize()
+    with bus_stats_lock:
+        bus_stats["queue_depth_max"] = max(bus_stats["queue_depth_max"], depth)
+    return future
+
+def run_on_bus(bus, func, *args):
+    """Execute a poll transaction on the bus worker and wait for its result"""
+    return submit_bus_job(bus, POLL_PRIORITY, func, *args).result()
+
+def record_job_timing(priority, wait, duration):
+    """Record how long a command or write batch waited for the bus and took to execute"""
+    if priority not in TIMED_JOBS:
+        return
+    counter, kind = TIMED_JOBS[priority]
+    logger.debug(f"{kind.capitalize()} waited {wait * 1000:.0f} ms, executed in {duration * 1000:.0f} ms")
+    observe(f"zity_{kind}_wait_seconds", wait)
+    observe(f"zity_{kind}_exec_seconds", duration)
+    with bus_stats_lock:
+        bus_stats[counter] += 1
+        bus_stats[f"{kind}_wait_total"] += wait
+        bus_stats[f"{kind}_wait_max"] = max(bus_stats[f"{kind}_wait_max"], wait)
+        bus_stats[f"{kind}_exec_total"] += duration
+        bus_stats[f"{kind}_exec_max"] = max(bus_stats[f"{kind}_exec_max"], duration)
+
+def record_bus_time(bus, duration):
+    inc_counter("zity_bus_busy_seconds_total", (("bus", bus.name),), amount=duration)
+    with bus_stats_lock:
+        bus_stats["busy_time"] += duration
+        bus.busy_time += duration
+
+def register_group(ctl, address):
+    """The register group used to label metrics for a register"""
+    if address == ctl.trigger_register:
+        return "trigger"
+    for name, addresses in ctl.poll_group_registers.items():
+        if address in addresses:
+            return name
+    return "command"
+
+def record_modbus_request(ctl, op, address, duration, error=None):
+    ctl.bus.last_request = time.monotonic()
+    observe("zity_modbus_request_seconds", duration, (("controller", ctl.name), ("op", op), ("group", register_group(ctl, address))))
+    if error is not None:
+        # pymodbus reports a missing response as an IO exception.
+        kind = "timeout" if "no response" in str(error).lower() or "timeout" in str(error).lower() else "exception"
+        inc_counter("zity_modbus_errors_total", (("controller", ctl.name), ("register", str(address)), ("type", kind)))
+
+metric_gauges["zity_bus_queue_depth"] = lambda: sum(bus.queue.qsize() for bus in buses.values())
+
+def bus_worker(bus):
+    while True:
+        priority, _, queued_at, func, args, future = bus.queue.get()
+        started = time.monotonic()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        record_bus_time(bus, time.monotonic() - started)
+        record_job_timing(priority, started - queued_at, time.monotonic() - started)
+
+# ------------------ Bus steps ------------------ #
+
+# Flushing writes and executing a read plan take several Modbus requests, with decisions
+# in between. That logic is written once, as a generator that yields the steps it needs
+# and gets their results back, or their exceptions raised where it yielded:
+#   ("read", start, count, holding)   returns the registers
+#   ("write", start, values)
+#   ("sleep", seconds)
+#   ("connect",)                      returns whether the client is connected
+# run_steps performs them for the threaded runtime and async_run_steps for the asyncio
+# runtime, which is all the two runtimes differ in.
+
+def perform_step(ctl, step):
+    """Perform a single step on the bus of a controller"""
+    kind, *args = step
+    if kind == "read":
+        return read_block(ctl, *args)
+    if kind == "write":
+        return write_block(ctl, *args)
+    if kind == "sleep":
+        return time.sleep(*args)
+    return ctl.bus.client.connect()
+
+def run_steps(steps, perform):
+    """Drive a generator of steps with perform(step); returns what the generator returns"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = perform(step), None
+        except Exception as e:
+            result, error = None, e
+
+# ------------------ Write coalescing ------------------ #
+
+# Register writes are collected for coalesce_window seconds before they are sent. A
+# newer write to the same register replaces a pending one, and writes to adjacent
+# registers are combined into a single write_registers call. Each batch needs only
+# one trigger write. Every controller has its own batch. The time from the first staged
+# write of a batch until the batch was sent is the write latency, which includes the
+# coalesce window and the wait for the bus.
+coalesce_window = config.get("commands", {}).get("coalesce_window", 0.3)
+
+pending_writes_lock = threading.Lock()
+write_stats = {
+    "writes_requested": 0, "bus_writes": 0, "writes_skipped": 0,
+    "writes_confirmed": 0, "write_retries": 0, "writes_unconfirmed": 0,
+    "write_latency_total": 0.0, "write_latency_max": 0.0
+}
+
+def stage_write(ctl, register, value):
+    """Queue a register write for the next batch of a controller"""
+    with pending_writes_lock:
+        ctl.pending_writes[register] = value
+        write_stats["writes_requested"] += 1
+        if ctl.flush_scheduled:
+            return
+        ctl.flush_scheduled = True
+        ctl.batch_staged_at = time.monotonic()
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(
+            event_loop.call_later, coalesce_window, submit_bus_job, ctl.bus, FLUSH_PRIORITY, async_flush_writes, ctl
+        )
+    elif coalesce_window > 0:
+        timer = threading.Timer(coalesce_window, submit_bus_job, (ctl.bus, FLUSH_PRIORITY, flush_writes, ctl))
+        timer.daemon = True
+        timer.start()
+    else:
+        submit_bus_job(ctl.bus, FLUSH_PRIORITY, flush_writes, ctl)
+
+# The master/slave and fan control registers hold configuration that set_fan_mode
+# applies to every zone, but it rarely changes. The values the bridge wrote are
+# remembered per controller and writes that are already in effect are skipped, so a
+# fan mode change normally writes just the fan mode. With the readback and adaptive
+# trigger_settle strategies, the flush reads the skipped registers back from the
+# controller's holding registers first, and writes those that no longer hold the value
+# after all; that costs a read instead of a write. With the fixed strategy, nothing is
+# read back, so the remembered values are trusted. The controller may lose the
+# configuration when it restarts, so it is written again after a reconnect.
+def stage_config_write(ctl, register, value):
+    """Like stage_write, but skip the write if the register already holds the value"""
+    with pending_writes_lock:
+        if ctl.config_written.get(register) == value and register not in ctl.pending_writes:
+            write_stats["writes_requested"] += 1
+            write_stats["writes_skipped"] += 1
+            ctl.skipped_config[register] = value
+            return
+    stage_write(ctl, register, value)
+
+def check_skipped_config_steps(ctl, skipped):
+    """Read the skipped config registers back; returns the writes they need after all"""
+    corrections = {}
+    for start, values in group_adjacent_writes(skipped):
+        held = yield ("read", start, len(values), True)
+        corrections.update(
+            (register, value) for register, value, current in zip(range(start, start + len(values)), values, held)
+            if current != value
+        )
+    if corrections:
+        logger.warning(f"{ctl.name}: config register(s) {', '.join(map(str, sorted(corrections)))} changed; writing them again")
+        with pending_writes_lock:
+            write_stats["writes_skipped"] -= len(corrections)
+    return corrections
+
+def record_config_written(ctl, start, values):
+    with pending_writes_lock:
+        for register, value in zip(range(start, start + len(values)), values):
+            if register in ctl.config_registers:
+                ctl.config_written[register] = value
+
+def forget_config_written(ctl):
+    with pending_writes_lock:
+        ctl.config_written.clear()
+
+def group_adjacent_writes(writes):
+    """Turn a dict of register -> value into (start, values) runs of adjacent registers.
+
+    The runs are returned in the order their first register was staged, so writes that
+    depend on earlier ones are still sent after them.
+    """
+    order = {register: index for index, register in enumerate(writes)}
+    runs = []
+    for register in sorted(writes):
+        if runs and runs[-1][0] + len(runs[-1][1]) == register:
+            runs[-1][1].append(writes[register])
+        else:
+            runs.append((register, [writes[register]]))
+    runs.sort(key=lambda run: min(order[run[0] + i] for i in range(len(run[1]))))
+    return runs
+
+def take_pending_writes(ctl):
+    """Take all pending and skipped config writes of a controller, and the time the first was staged"""
+    with pending_writes_lock:
+        writes = ctl.pending_writes
+        skipped = {register: value for register, value in ctl.skipped_config.items() if register not in writes}
+        staged_at = ctl.batch_staged_at
+        ctl.pending_writes = {}
+        ctl.skipped_config = {}
+        ctl.flush_scheduled = False
+    return writes, skipped, staged_at
+
+def record_bus_writes(runs, attempts, staged_at):
+    latency = time.monotonic() - staged_at
+    observe("zity_write_latency_seconds", latency)
+    with pending_writes_lock:
+        write_stats["bus_writes"] += 1 + attempts * len(runs)
+        write_stats["write_latency_total"] += latency
+        write_stats["write_latency_max"] = max(write_stats["write_latency_max"], latency)
+
+def log_unsettled_writes(ctl, runs):
+    logger.warning(
+        f"{ctl.name}: writes to register(s) {', '.join(str(start) for start, _ in runs)} "
+        f"did not take effect within {ctl.trigger_settle.max_delay} s"
+    )
+
+def flush_steps(ctl):
+    """Send all pending writes: one trigger write, then one write per run of adjacent registers"""
+    writes, skipped, staged_at = take_pending_writes(ctl)
+    if not writes:
+        return
+
+    settle = ctl.trigger_settle
+    attempts = 0
+    runs = []
+    try:
+        if settle.verify and skipped:
+            # The skipped writes go first, in the order they were staged.
+            writes = {**(yield from check_skipped_config_steps(ctl, skipped)), **writes}
+        runs = group_adjacent_writes(writes)
+        yield ("write", ctl.trigger_register, [1])
+        triggered = time.monotonic()
+        delay = settle.first_delay()
+        settled = False
+        while delay is not None:
+            yield ("sleep", max(0.0, triggered + delay - time.monotonic()))
+            waited = time.monotonic() - triggered
+            attempts += 1
+            for start, values in runs:
+                yield ("write", start, values)
+            matches = True
+            for start, values in runs if settle.verify else []:
+                if (yield ("read", start, len(values), True)) != values:
+                    matches = False
+                    break
+            if matches:
+                settle.settled(waited)
+                settled = True
+                break
+            delay = settle.retry_delay(delay)
+        else:
+            log_unsettled_writes(ctl, runs)
+            # Nobody knows what the config registers hold now, so write them again next time.
+            forget_config_written(ctl)
+        invalidate_written_registers(ctl, runs)
+        for start, values in runs:
+            if settled:
+                record_config_written(ctl, start, values)
+            logger.debug(f"{ctl.name}: wrote {values} to register(s) {start}-{start + len(values) - 1}")
+    except Exception as e:
+        logger.error(f"{ctl.name}: error writing registers: {e}")
+    record_bus_writes(runs, attempts, staged_at)
+
+def flush_writes(ctl):
+    """Flush the pending writes of a controller; runs on the bus worker"""
+    run_steps(flush_steps(ctl), lambda step: perform_step(ctl, step))
+
+# ------------------ Write confirmation ------------------ #
+
+# A command records, per zone field it changes ("setpoint", "mode", "fan_mode" or
+# "preset_mode"), the value the controller should report once the write took effect,
+# together with the write itself and a deadline. While a field is pending it is neither
+# published nor checked for manual changes; the other fields of the zone are. The zone
+# is read back every readback_interval seconds, reading only the registers of pending
+# fields, and the first read that matches confirms the field. When the deadline passes,
+# the write is staged again, up to confirm_retries times; then the bridge gives up and
+# goes with what the controller reports.
+confirm_timeout = config.get("commands", {}).get("confirm_timeout", 30)
+confirm_retries = config.get("commands", {}).get("confirm_retries", 1)
+
+FIELD_READ_REGISTERS = {
+    "setpoint": "setpoint_read_register",
+    "mode": "status_read_register",
+    "fan_mode": "fan_mode_read_register",
+    "preset_mode": "preset_mode_read_register"
+}
+# The zone state keeps the setpoint last sent through MQTT as temp.
+FIELD_STATE_NAMES = {"setpoint": "temp", "mode": "mode", "fan_mode": "fan_mode", "preset_mode": "preset_mode"}
+
+def expect_readback(ctl, zone_id, field, expected, register, value, **changes):
+    """Wait for a staged write to show up as expected in a zone field.
+
+    changes are applied to the zone state in the same swap, typically the MQTT value.
+    """
+    now = time.monotonic()
+    entry = {
+        "expected": expected, "register": register, "value": value,
+        "since": now, "deadline": now + confirm_timeout, "retries": 0
+    }
+    with state_lock:
+        state = ctl.zone_states[zone_id]
+        ctl.zone_states[zone_id] = state.replace(pending=dict(state.pending, **{field: entry}), **changes)
+    request_readback(ctl, zone_id)
+
+def confirm_pending_writes(ctl, zone_id, current_values):
+    """Confirm, retry or give up the pending writes of a zone; returns the fields still pending"""
+    state = ctl.zone_states[zone_id]
+    if not state.pending:
+        return set()
+    now = time.monotonic()
+    outcome = {}
+    changes = {}
+    for field, entry in state.pending.items():
+        if field not in current_values:
+            # Its register could not be read; wait for a read that works.
+            continue
+        current = current_values[field]
+        if current == entry["expected"]:
+            logger.info(f"Zone {zone_id}: {field} {current} confirmed after {now - entry['since']:.1f} s")
+            observe("zity_write_confirm_seconds", now - entry["since"], (("controller", ctl.name),))
+            outcome[field] = None
+            counter = "writes_confirmed"
+        elif now < entry["deadline"]:
+            continue
+        elif entry["retries"] < confirm_retries:
+            logger.warning(f"Zone {zone_id}: {field} still {current} instead of {entry['expected']}; writing it again")
+            stage_write(ctl, entry["register"], entry["value"])
+            outcome[field] = dict(entry, deadline=now + confirm_timeout, retries=entry["retries"] + 1)
+            counter = "write_retries"
+        else:
+            logger.error(f"Zone {zone_id}: {field} did not change to {entry['expected']}; the controller reports {current}")
+            # Take over the controller's value, so it isn't mistaken for a manual change.
+            changes[FIELD_STATE_NAMES[field]] = current
+            outcome[field] = None
+            counter = "writes_unconfirmed"
+        with pending_writes_lock:
+            write_stats[counter] += 1
+
+    with state_lock:
+        # A command may have swapped in a new record since; only touch the entries we examined.
+        latest = ctl.zone_states[zone_id]
+        pending = dict(latest.pending)
+        for field, entry in outcome.items():
+            if pending.get(field) is not state.pending[field]:
+                continue
+            if entry is None:
+                del pending[field]
+            else:
+                pending[field] = entry
+        ctl.zone_states[zone_id] = latest.replace(pending=pending, **changes)
+    return set(pending)
+
+# ------------------ Read planner ------------------ #
+
+# Input registers read for every zone. Measured values change all the time; the
+# settings only change through commands or the thermostat.
+ZONE_MEASUREMENT_REGISTERS = [
+    "temp_read_register",
+    "damper_status_read_register"
+]
+ZONE_SETTING_REGISTERS = [
+    "setpoint_read_register",
+    "status_read_register",
+    "fan_mode_read_register",
+    "preset_mode_read_register"
+]
+ZONE_READ_REGISTERS = ZONE_MEASUREMENT_REGISTERS + ZONE_SETTING_REGISTERS
+
+max_block_size = config.get("modbus", {}).get("max_block_size", 32)
+max_gap = config.get("modbus", {}).get("max_gap", 4)
+
+def poll_group_addresses(ctl):
+    """Return the input register addresses of each poll group of a controller"""
+    groups = {
+        "zone_temps": set(),
+        # The zone mode depends on the system mode, so read that with the settings.
+        "zone_settings": {ctl.overall_status_register},
+        "system": set(),
+        "alarms": set(ctl.alarm_registers)
+    }
+    for zone in ctl.zones.values():
+        groups["zone_temps"].update(zone[key] for key in ZONE_MEASUREMENT_REGISTERS)
+        groups["zone_settings"].update(zone[key] for key in ZONE_SETTING_REGISTERS)
+    for key, reg in ctl.system_registers.items():
+        if "write" in key:
+            continue
+        groups["system"].add(reg)
+    return groups
+
+def plan_block_reads(addresses, avoid=(), block_size=None, gap_size=None):
+    """Merge register addresses into as few block reads as possible.
+
+    Addresses at most max_gap registers apart end up in the same block, as long as
+    the block does not span more than max_block_size registers; block_size and
+    gap_size override those. Each block is a tuple (start, count, addresses), where
+    addresses are the registers we actually need from that block. Blocks never span a
+    register in avoid; those that are wanted are read on their own.
+    """
+    block_size = max_block_size if block_size is None else block_size
+    gap_size = max_gap if gap_size is None else gap_size
+    blocks = []
+    for address in sorted(addresses):
+        if blocks and address not in avoid:
+            start, count, wanted = blocks[-1]
+            gap = address - (start + count)
+            if (gap <= gap_size and address - start < block_size
+                    and not any(start <= avoided < address for avoided in avoid)):
+                blocks[-1] = (start, address - start + 1, wanted + (address,))
+                continue
+        blocks.append((address, 1, (address,)))
+    return blocks
+
+def check_read_result(result, start, count):
+    if result.isError():
+        raise Exception(f"Modbus error response reading {count} register(s) at {start}: {result}")
+    return result.registers
+
+def check_write_result(result, start, count):
+    if result.isError():
+        raise Exception(f"Modbus error response writing {count} register(s) at {start}: {result}")
+
+def read_block(ctl, start, count, holding=False):
+    """Read input registers, or holding registers to check what was written"""
+    read = ctl.bus.client.read_holding_registers if holding else ctl.bus.client.read_input_registers
+    time.sleep(ctl.bus.request_gap())
+    started = time.monotonic()
+    try:
+        registers = check_read_result(read(start, count, slave=ctl.slave_id), start, count)
+    except Exception as e:
+        record_modbus_request(ctl, "read", start, time.monotonic() - started, e)
+        raise
+    record_modbus_request(ctl, "read", start, time.monotonic() - started)
+    return registers
+
+def write_block(ctl, start, values):
+    time.sleep(ctl.bus.request_gap())
+    started = time.monotonic()
+    try:
+        check_write_result(ctl.bus.client.write_registers(start, values, slave=ctl.slave_id), start, len(values))
+    except Exception as e:
+        record_modbus_request(ctl, "write", start, time.monotonic() - started, e)
+        raise
+    record_modbus_request(ctl, "write", start, time.monotonic() - started)
+
+def reconnect_steps(ctl, error):
+    """Reconnect if a failed request dropped the connection; returns False if that failed"""
+    if ctl.bus.client.connected:
+        return True
+    logger.warning(f"{ctl.name}: the connection dropped ({error}); reconnecting")
+    try:
+        connected = yield ("connect",)
+    except Exception as e:
+        logger.error(f"{ctl.name}: reconnection failed: {e}")
+        return False
+    if connected:
+        ctl.bus.reconnected()
+    return bool(connected)
+
+def read_plan_steps(ctl, plan):
+    """Execute a read plan.
+
+    Returns a dict of register address -> value and the set of wanted registers that
+    could not be read. A read that drops the connection, as a timeout does with the
+    asyncio clients, is retried as any failed read once the bus is reconnected, and the
+    rest of the plan is read after it. Only when reconnecting fails, the rest of the plan
+    is skipped; its registers are in neither, as they are not to blame.
+    """
+    values = {}
+    failed = set()
+    for start, count, wanted in plan:
+        try:
+            registers = yield ("read", start, count, False)
+            values.update(zip(range(start, start + count), registers))
+            continue
+        except Exception as e:
+            error = e
+        if not (yield from reconnect_steps(ctl, error)):
+            logger.error(f"{ctl.name}: lost the connection reading {start}-{start + count - 1}: {error}")
+            break
+        if count == 1:
+            logger.error(f"{ctl.name}: read error register {start}: {error}")
+            failed.add(start)
+            continue
+        # The controller may refuse a block spanning unsupported registers, or a dead
+        # register may make it time out. Fall back to reading the registers we need one by
+        # one, so a single bad register does not cost us the whole block.
+        logger.warning(f"{ctl.name}: block read {start}-{start + count - 1} failed ({error}); reading registers individually.")
+        for address in wanted:
+            try:
+                values[address] = (yield ("read", address, 1, False))[0]
+                continue
+            except Exception as e:
+                error = e
+            if not (yield from reconnect_steps(ctl, error)):
+                logger.error(f"{ctl.name}: lost the connection reading register {address}: {error}")
+                return values, failed
+            logger.error(f"{ctl.name}: read error register {address}: {error}")
+            failed.add(address)
+    return values, failed
+
+def read_planned_registers(ctl, plan):
+    """Execute a read plan from a poller, every request as its own bus job"""
+    return run_steps(read_plan_steps(ctl, plan), lambda step: run_on_bus(ctl.bus, perform_step, ctl, step))
+
+def describe_plan(plan):
+    return (
+        f"{len(plan)} block read(s) for {sum(len(b[2]) for b in plan)} registers: "
+        + ", ".join(f"{start}-{start + count - 1}" if count > 1 else f"{start}" for start, count, _ in plan)
+    )
+
+# Plans are cached per set of registers, because the poll scheduler reads the same
+# combinations of groups over and over. Controllers with the same register map share
+# their plans.
+read_plan_cache = {}
+
+def read_plan_for(addresses, avoid=frozenset()):
+    """The read plan for some registers, with the reads of the registers in avoid last.
+
+    Those are the registers that failed before. A timeout on them then can no longer
+    delay the reads of the healthy registers, nor drop the connection before those.
+    """
+    key = (frozenset(addresses), avoid)
+    plan = read_plan_cache.get(key)
+    if plan is None:
+        plan = plan_block_reads(*key)
+        plan.sort(key=lambda block: any(address in avoid for address in block[2]))
+        read_plan_cache[key] = plan
+    return plan
+
+for ctl in controllers:
+    ctl.poll_group_registers = poll_group_addresses(ctl)
+    for group_name, group_addresses in ctl.poll_group_registers.items():
+        logger.info(f"{ctl.name}: read plan {group_name}: {describe_plan(read_plan_for(group_addresses))}")
+    logger.info(f"{ctl.name}: read plan full cycle: {describe_plan(read_plan_for(set().union(*ctl.poll_group_registers.values())))}")
+
+# ------------------ Register health ------------------ #
+
+# A register that fails breaker_threshold reads in a row trips its circuit breaker: it
+# is left out of the polls for breaker_backoff seconds, after which it is probed again.
+# Every failed probe doubles the wait, up to breaker_max_backoff; a successful read
+# closes the breaker. Block reads are planned around tripped registers and probes are
+# read on their own, so a dead thermostat or an unsupported register no longer costs a
+# timeout, or a failed block read, in every poll. Registers that failed at all are read
+# on their own until they succeed, which also finds the culprit of a failed block read.
+# Zones and the system are marked offline on their availability topics while any of
+# their registers is tripped, and so is every alarm whose register is tripped.
+breaker_threshold = config.get("polling", {}).get("breaker_threshold", 3)
+breaker_backoff = config.get("polling", {}).get("breaker_backoff", 30)
+breaker_max_backoff = config.get("polling", {}).get("breaker_max_backoff", 600)
+register_health_lock = threading.Lock()
+
+def tripped_registers(ctl):
+    """Return the registers of a controller whose breaker is open, as a frozenset"""
+    with register_health_lock:
+        return frozenset(address for address, health in ctl.register_health.items() if health["tripped"])
+
+def failing_registers(ctl):
+    """Return the registers of a controller that failed since they were last read, as a frozenset"""
+    with register_health_lock:
+        return frozenset(ctl.register_health)
+
+def skip_tripped_registers(ctl, addresses):
+    """Leave out the tripped registers that are not due for a probe"""
+    now = time.monotonic()
+    with register_health_lock:
+        skipped = {
+            address for address, health in ctl.register_health.items()
+            if health["tripped"] and health["retry_at"] > now
+        }
+    return addresses - skipped
+
+def record_register_health(ctl, values, failed):
+    """Update the breakers of the registers that were read, or failed to be read"""
+    now = time.monotonic()
+    with register_health_lock:
+        for address in [address for address in ctl.register_health if address in values]:
+            if ctl.register_health.pop(address)["tripped"]:
+                logger.info(f"{ctl.name}: register {address} responds again")
+        for address in failed:
+            health = ctl.register_health.get(address)
+            if health is None:
+                health = ctl.register_health[address] = {"failures": 0, "tripped": False, "backoff": 0, "retry_at": 0}
+            health["failures"] += 1
+            if health["tripped"]:
+                health["backoff"] = min(health["backoff"] * 2, breaker_max_backoff)
+            elif health["failures"] >= breaker_threshold:
+                health["tripped"] = True
+                health["backoff"] = breaker_backoff
+                logger.warning(
+                    f"{ctl.name}: register {address} failed {health['failures']} times; "
+                    f"skipping it, probing again in {breaker_backoff} s"
+                )
+                inc_counter("zity_register_trips_total", (("controller", ctl.name),))
+            health["retry_at"] = now + health["backoff"]
+    # Only changes are actually published.
+    publish_availability(ctl)
+
+def publish_availability(ctl):
+    """Publish the availability of every zone, the system and every alarm of a controller"""
+    tripped = tripped_registers(ctl)
+    for zone_id, zone in ctl.zones.items():
+        available = not any(zone[key] in tripped for key in ZONE_READ_REGISTERS)
+        publish_state(f"{ctl.base_topic}/zone/{zone_id}/availability", "online" if available else "offline")
+    available = not any(reg in tripped for key, reg in ctl.system_registers.items() if "write" not in key)
+    publish_state(f"{ctl.base_topic}/system/availability", "online" if available else "offline")
+    for reg in ctl.alarm_registers:
+        publish_state(alarm_availability_topic(ctl, reg), "offline" if reg in tripped else "online")
+
+def alarm_availability_topic(ctl, reg):
+    return f"{ctl.base_topic}/system/alarm_{reg}/availability"
+
+def register_health_stats(ctl):
+    with register_health_lock:
+        failing = {address: dict(health) for address, health in ctl.register_health.items()}
+    now = time.monotonic()
+    return {
+        str(address): {
+            "failures": health["failures"],
+            "tripped": health["tripped"],
+            "retry_in": round(max(0, health["retry_at"] - now), 1) if health["tripped"] else None
+        } for address, health in sorted(failing.items())
+    }
+
+metric_gauges["zity_registers_tripped"] = lambda: sum(len(tripped_registers(ctl)) for ctl in controllers)
+
+# ------------------ Register cache ------------------ #
+
+# The latest value of every input register the bridge read is kept per controller,
+# together with the time it was read. A value read less than cache_ttl seconds ago is
+# used instead of reading the register again: commands take the overall system mode a
+# zone follows from the cache, and a poll skips registers that another poll group or a
+# command read just before. Writing a register makes the input registers that reflect
+# it stale, so the next read gets the new value from the controller. Read-backs after a
+# command always read. Keep cache_ttl below the poll intervals.
+register_cache_ttl = config.get("polling", {}).get("cache_ttl", 5)
+register_cache_lock = threading.Lock()
+register_cache_stats = {"register_cache_hits": 0}
+
+def written_read_registers(ctl):
+    """Map the write registers of a controller to the input registers that reflect them"""
+    mapping = {}
+    for zone in ctl.zones.values():
+        for key, address in zone.items():
+            read_key = key.replace("_write_register", "_read_register")
+            if read_key != key and read_key in zone:
+                mapping.setdefault(address, set()).add(zone[read_key])
+    for key, address in ctl.system_registers.items():
+        if key.endswith("_write") and key[:-len("_write")] in ctl.system_registers:
+            mapping.setdefault(address, set()).add(ctl.system_registers[key[:-len("_write")]])
+    return mapping
+
+def cache_registers(ctl, values):
+    """Store register values that were just read"""
+    now = time.monotonic()
+    with register_cache_lock:
+        ctl.register_values.update(values)
+        ctl.register_read_at.update(dict.fromkeys(values, now))
+
+def fresh_registers(ctl, addresses):
+    """The addresses whose cached value is recent enough to use, counted as cache hits"""
+    now = time.monotonic()
+    with register_cache_lock:
+        fresh = {address for address in addresses if now - ctl.register_read_at.get(address, -register_cache_ttl) < register_cache_ttl}
+        register_cache_stats["register_cache_hits"] += len(fresh)
+    return fresh
+
+def invalidate_written_registers(ctl, runs):
+    """Mark the input registers that reflect written registers as stale"""
+    with register_cache_lock:
+        for start, values in runs:
+            for address in range(start, start + len(values)):
+                for read_address in ctl.written_read_registers.get(address, ()):
+                    ctl.register_read_at.pop(read_address, None)
+
+for ctl in controllers:
+    ctl.written_read_registers = written_read_registers(ctl)
+
+def current_register_values(ctl):
+    """The cached register values, without those of registers whose last read failed"""
+    failing = failing_registers(ctl)
+    with register_cache_lock:
+        return {address: value for address, value in ctl.register_values.items() if address not in failing}
+
+def cached_read(ctl, address):
+    """The value of an input register, from the cache if it is fresh"""
+    if fresh_registers(ctl, [address]):
+        return ctl.register_values[address]
+    value = read_block(ctl, address, 1)[0]
+    cache_registers(ctl, {address: value})
+    return value
+
+# ------------------ Outbound queue ------------------ #
+
+# Everything the bridge publishes goes through a bounded queue with one slot per topic:
+# a newer value replaces an unsent older one, so after a slow spell or a reconnect the
+# broker gets the latest values instead of a burst of stale ones. A publisher thread (or
+# task) sends the queue, command echoes first, then states, then discovery configs and
+# stats, while fewer than max_inflight messages are on their way and at no more than
+# rate_limit messages per second (0 for no limit). When max_queued topics are waiting,
+# a new message pushes out the oldest one of a lower class, or is dropped itself.
+publishing_config = config.get("publishing", {})
+
+PUBLISH_COMMAND = 0
+PUBLISH_STATE = 1
+PUBLISH_BULK = 2
+
+max_inflight = publishing_config.get("max_inflight", 20)
+rate_limit = publishing_config.get("rate_limit", 0)
+max_queued = publishing_config.get("max_queued", 1000)
+
+outbound_lock = threading.Lock()
+# One OrderedDict of topic -> (payload, retain) per class, oldest first
+outbound_queues = [OrderedDict() for _ in (PUBLISH_COMMAND, PUBLISH_STATE, PUBLISH_BULK)]
+outbound_classes = {}
+outbound_counters = {"publishes_superseded": 0, "publishes_dropped": 0}
+outbound_inflight = 0
+# Token bucket of the rate limit, holding at most a second's worth of messages
+publish_tokens = {"tokens": float(rate_limit), "at": time.monotonic()}
+publish_wakeup = threading.Event()
+
+def enqueue_publish(topic, payload, retain=True, priority=PUBLISH_STATE):
+    """Queue a message, replacing an unsent one for the same topic"""
+    dropped = None
+    with outbound_lock:
+        queued = outbound_classes.get(topic)
+        if queued == priority:
+            outbound_counters["publishes_superseded"] += 1
+        elif queued is not None:
+            del outbound_queues[queued][topic]
+            outbound_counters["publishes_superseded"] += 1
+            priority = min(priority, queued)
+        elif len(outbound_classes) >= max_queued:
+            victim = next((cls for cls in (PUBLISH_BULK, PUBLISH_STATE) if cls > priority and outbound_queues[cls]), None)
+            outbound_counters["publishes_dropped"] += 1
+            inc_counter("zity_mqtt_dropped_total")
+            if victim is None:
+                dropped = topic
+            else:
+                dropped, _ = outbound_queues[victim].popitem(last=False)
+                del outbound_classes[dropped]
+        if dropped != topic:
+            outbound_queues[priority][topic] = (payload, retain)
+            outbound_classes[topic] = priority
+    if dropped is not None:
+        # Not sent after all, so the next poll publishes the value again.
+        with publish_cache_lock:
+            publish_cache.pop(dropped, None)
+    wake_publisher()
+
+def wake_publisher():
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(publish_wakeup.set)
+    else:
+        publish_wakeup.set()
+
+def next_outbound():
+    """Take the next message to send, or return (None, seconds to wait; None for a wakeup)"""
+    global outbound_inflight
+    with outbound_lock:
+        if not outbound_classes or not client.is_connected() or outbound_inflight >= max_inflight:
+            return None, None
+        if rate_limit:
+            now = time.monotonic()
+            publish_tokens["tokens"] = min(rate_limit, publish_tokens["tokens"] + (now - publish_tokens["at"]) * rate_limit)
+            publish_tokens["at"] = now
+            if publish_tokens["tokens"] < 1:
+                return None, (1 - publish_tokens["tokens"]) / rate_limit
+            publish_tokens["tokens"] -= 1
+        queue = next(queue for queue in outbound_queues if queue)
+        topic, (payload, retain) = queue.popitem(last=False)
+        del outbound_classes[topic]
+        outbound_inflight += 1
+        return (topic, payload, retain), None
+
+def send_outbound():
+    """Send queued messages as far as the limits allow; returns how long to wait, like next_outbound"""
+    global outbound_inflight
+    while True:
+        message, delay = next_outbound()
+        if message is None:
+            return delay
+        topic, payload, retain = message
+        if client.publish(topic, payload, retain=retain).rc != mqtt.MQTT_ERR_SUCCESS:
+            # The connection just went down. Keep the message for the reconnect, unless a
+            # newer value was queued in the meantime.
+            with outbound_lock:
+                outbound_inflight -= 1
+                if topic not in outbound_classes:
+                    outbound_queues[PUBLISH_COMMAND][topic] = (payload, retain)
+                    outbound_queues[PUBLISH_COMMAND].move_to_end(topic, last=False)
+                    outbound_classes[topic] = PUBLISH_COMMAND
+            return None
+
+def message_sent():
+    """on_publish: a message left, so there is room for the next one"""
+    global outbound_inflight
+    with outbound_lock:
+        outbound_inflight = max(0, outbound_inflight - 1)
+    wake_publisher()
+
+def reset_inflight():
+    """on_connect: messages of the previous connection will never be sent now"""
+    global outbound_inflight
+    with outbound_lock:
+        outbound_inflight = 0
+    wake_publisher()
+
+def outbound_depth():
+    with outbound_lock:
+        return len(outbound_classes)
+
+metric_gauges["zity_mqtt_queue_depth"] = outbound_depth
+
+def publish_worker():
+    while True:
+        publish_wakeup.clear()
+        publish_wakeup.wait(send_outbound())
+
+async def async_publish_worker():
+    while True:
+        publish_wakeup.clear()
+        try:
+            await asyncio.wait_for(publish_wakeup.wait(), send_outbound())
+        except asyncio.TimeoutError:
+            pass
+
+# ------------------ Publish cache ------------------ #
+
+# State topics are only republished when their value changes, or when the value has
+# not been sent for refresh_interval seconds. Temperatures get a deadband, so small
+# fluctuations do not cause a publish either.
+temp_deadband = publishing_config.get("temp_deadband", 0)
+refresh_interval = publishing_config.get("refresh_interval", 600)
+
+# With state_format json, the fields of every zone, and those of the system including
+# the alarms, are published together as a JSON document with a timestamp on
+# <base_topic>/zone/<zone>/state and <base_topic>/system/state, instead of as separate
+# topics. That is one retained message per zone per poll instead of up to seven, and
+# consumers get a consistent snapshot; the discovery configs point into the documents
+# with value templates. state_format both publishes the documents and the separate
+# topics. A document is published after a poll or command that changed one of its
+# fields, so the publish cache still decides what counts as a change.
+STATE_FORMATS = ("topics", "json", "both")
+state_format = publishing_config.get("state_format", "topics")
+if state_format not in STATE_FORMATS:
+    raise ValueError(f"Unknown state_format {state_format}")
+publish_topics = state_format != "json"
+publish_documents = state_format != "topics"
+# Home Assistant watches the availability topics themselves.
+DOCUMENT_EXCLUDED_FIELDS = ("availability",)
+
+publish_cache_lock = threading.Lock()
+publish_cache = {}
+publish_counters = {"sent": 0, "suppressed": 0, "documents_sent": 0}
+# document prefix -> {"fields": {...}, "dirty": changed since it was last published}
+state_documents = {}
+
+def state_document(topic):
+    """The state document a state topic belongs to, or None; call with publish_cache_lock held"""
+    prefix, field = topic.rsplit("/", 1)
+    if not publish_documents or field in DOCUMENT_EXCLUDED_FIELDS:
+        return None, field
+    return state_documents.setdefault(prefix, {"fields": {}, "dirty": False}), field
+
+def publish_state(topic, value, deadband=0, force=False):
+    """Publish a retained state value, unless it did not change since it was last sent"""
+    payload = str(value)
+    now = time.monotonic()
+    with publish_cache_lock:
+        # The document always holds the latest value, so it is complete when a change
+        # of another field publishes it.
+        document, field = state_document(topic)
+        if document is not None:
+            document["fields"][field] = value
+        cached = publish_cache.get(topic)
+        if cached is not None and not force and now - cached[1] < refresh_interval:
+            last_payload = cached[0]
+            if deadband:
+                try:
+                    # Readings come in tenths, so 21.5 -> 21.7 must count as a change of 0.2.
+                    unchanged = abs(float(payload) - float(last_payload)) < deadband - 1e-9
+                except ValueError:
+                    unchanged = payload == last_payload
+            else:
+                unchanged = payload == last_payload
+            if unchanged:
+                publish_counters["suppressed"] += 1
+                return
+        publish_cache[topic] = (payload, now)
+        if document is not None:
+            document["dirty"] = True
+            if not publish_topics:
+                return
+        publish_counters["sent"] += 1
+    # Commands publish their new values right away, with force.
+    enqueue_publish(topic, payload, priority=PUBLISH_COMMAND if force else PUBLISH_STATE)
+
+def note_state(topic, value):
+    """Put a state that is always published as its own topic in its state document too"""
+    with publish_cache_lock:
+        document, field = state_document(topic)
+        if document is not None and document["fields"].get(field) != value:
+            document["fields"][field] = value
+            document["dirty"] = True
+
+def publish_state_documents(priority=PUBLISH_STATE):
+    """Publish the state documents that changed since they were last published"""
+    if not publish_documents:
+        return
+    with publish_cache_lock:
+        due = [(prefix, dict(document["fields"])) for prefix, document in state_documents.items() if document["dirty"]]
+        for prefix, _ in due:
+            state_documents[prefix]["dirty"] = False
+        publish_counters["documents_sent"] += len(due)
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    for prefix, fields in due:
+        fields["timestamp"] = timestamp
+        enqueue_publish(f"{prefix}/state", json.dumps(fields), priority=priority)
+
+def clear_publish_cache():
+    """Forget what was published, so everything is sent again in the next poll"""
+    with publish_cache_lock:
+        publish_cache.clear()
+        for document in state_documents.values():
+            document["dirty"] = True
+
+# ------------------ State snapshot ------------------ #
+
+# With a state_file, the zone states and the published values survive a restart. The
+# bridge then knows right away what it sent last, so it can detect manual overrides in
+# the first poll and doesn't republish values the broker already has.
+startup_config = config.get("startup", {})
+# A replay must not overwrite the snapshot of the live bridge.
+state_file = None if replay else startup_config.get("state_file")
+state_restored = False
+last_saved_state = None
+
+def load_state_snapshot():
+    """Restore zone states and the publish cache from the state file, if there is one"""
+    global state_restored, last_saved_state
+    if not state_file or not os.path.exists(state_file):
+        return
+    try:
+        with open(state_file, "r") as f:
+            snapshot = json.load(f)
+        now = time.monotonic()
+        if "zones" in snapshot:
+            # Written before the bridge knew about multiple controllers.
+            snapshot["controllers"] = {controllers[0].name: snapshot.pop("zones")}
+        for ctl in controllers:
+            for zone_id, fields in snapshot["controllers"].get(ctl.name, {}).items():
+                if zone_id in ctl.zones:
+                    update_zone_state(ctl, zone_id, **{name: fields[name] for name in ZoneState.__slots__ if name in fields})
+            ctl.first_poll_completed = ctl.name in snapshot["controllers"]
+        with publish_cache_lock:
+            for topic, payload in snapshot["published"].items():
+                publish_cache[topic] = (payload, now)
+    except Exception as e:
+        logger.error(f"Error loading state file {state_file}: {e}")
+        return
+    last_saved_state = snapshot
+    state_restored = True
+    logger.info(f"Restored the state of {len(snapshot['controllers'])} controller(s) from {state_file}")
+
+def save_state_snapshot():
+    """Write zone states and published values to the state file, if they changed"""
+    global last_saved_state
+    if not state_file:
+        return
+    snapshot = {
+        # Pending writes belong to commands in progress; those don't survive a restart.
+        "controllers": {
+            ctl.name: {
+                zone_id: {name: getattr(state, name) for name in ZoneState.__slots__ if name != "pending"}
+                for zone_id, state in ctl.zone_states.items()
+            } for ctl in controllers
+        },
+        "published": {}
+    }
+    with publish_cache_lock:
+        snapshot["published"] = {topic: cached[0] for topic, cached in publish_cache.items()}
+    if snapshot == last_saved_state:
+        return
+    try:
+        # Write a new file and move it into place, so a crash never leaves half a file.
+        with open(state_file + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(state_file + ".tmp", state_file)
+        last_saved_state = snapshot
+    except Exception as e:
+        logger.error(f"Error saving state file {state_file}: {e}")
+
+def bus_occupancy(bus):
+    """Fraction of the time since the previous call that the bus was busy"""
+    now = time.monotonic()
+    with bus_stats_lock:
+        busy_time = bus.busy_time
+    since, busy_before = bus.last_stats
+    bus.last_stats = (now, busy_time)
+    return (busy_time - busy_before) / (now - since) if now > since else 0.0
+
+def mqtt_publish_rate():
+    """MQTT publishes per second since the previous call"""
+    global last_publish_count
+    now = time.monotonic()
+    with metrics_lock:
+        count = metric_values.get(("zity_mqtt_publishes_total", ()), 0)
+    since, count_before = last_publish_count
+    last_publish_count = (now, count)
+    return (count - count_before) / (now - since) if now > since else 0.0
+
+def publish_bridge_stats():
+    with publish_cache_lock:
+        stats = dict(publish_counters)
+    with bus_stats_lock:
+        stats.update(bus_stats)
+    with pending_writes_lock:
+        stats.update(write_stats)
+    stats.update(discovery_counters)
+    # Without coalescing, every write would have needed its own trigger write. Skipped
+    # writes count as requested, so they are included in the savings.
+    stats["bus_writes_saved"] = 2 * stats["writes_requested"] - stats["bus_writes"]
+    stats["queue_depth"] = sum(bus.queue.qsize() for bus in buses.values())
+    # The busiest bus limits how fast the bridge can go.
+    stats["buses"] = {bus.name: round(bus_occupancy(bus), 3) for bus in buses.values()}
+    stats["bus_occupancy"] = max(stats["buses"].values())
+    stats["poll_groups"] = {ctl.name: poll_group_stats(ctl) for ctl in controllers}
+    stats["trigger_settle"] = {ctl.name: ctl.trigger_settle.stats() for ctl in controllers}
+    stats["failing_registers"] = {ctl.name: register_health_stats(ctl) for ctl in controllers}
+    with register_cache_lock:
+        stats.update(register_cache_stats)
+    stats["mqtt_publish_rate"] = mqtt_publish_rate()
+    stats["mqtt_inflight"] = mqtt_inflight()
+    stats["mqtt_queue_depth"] = outbound_depth()
+    with outbound_lock:
+        stats.update(outbound_counters)
+    stats = {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+    logger.debug(f"Publish stats: {stats}")
+    enqueue_publish(f"{base_topic}/bridge/stats", json.dumps(stats), retain=False, priority=PUBLISH_BULK)
 
 # ------------------ MQTT Discovery helpers ------------------ #
 
-def publish_discovery(zone_id):
-    zone = zones[zone_id]
-    topic_prefix = f"homeassistant/climate/zity_zone_{zone_id}"
-    object_id = f"zity_zone_{zone_id}"
+# Discovery payloads only depend on the configuration, so they are built and serialized
+# once. On a (re)connect, the bridge reads the retained configs back from the broker and
+# only publishes the ones whose content hash differs. Every discovery_interval seconds,
+# all of them are published anyway, also on a connection that stays up; set it to 0 to
+# publish them on every connect instead.
+discovery_interval = publishing_config.get("discovery_interval", 86400)
+
+def use_state_document(config_payload, topic_key, template_key):
+    """Point a state topic of a discovery config into its state document, if those are published"""
+    if not publish_documents:
+        return
+    prefix, field = config_payload[topic_key].rsplit("/", 1)
+    config_payload[topic_key] = f"{prefix}/state"
+    config_payload[template_key] = f"{{{{ value_json.{field} }}}}"
+
+def zone_discovery_configs(ctl, zone_id):
+    """Return the (topic, payload) discovery configs of a zone"""
+    zone = ctl.zones[zone_id]
+    topic_prefix = f"homeassistant/climate/{ctl.id_prefix}_zone_{zone_id}"
+    object_id = f"{ctl.id_prefix}_zone_{zone_id}"
+    zone_topic = f"{ctl.base_topic}/zone/{zone_id}"
     name = "Airco " + zone["name"]
 
     climate_config = {
         "name": name,
         "unique_id": object_id,
-        "mode_command_topic": f"{base_topic}/zone/{zone_id}/set_mode",
-        "mode_state_topic": f"{base_topic}/zone/{zone_id}/mode",
-        "temperature_command_topic": f"{base_topic}/zone/{zone_id}/set_temp",
-        "temperature_state_topic": f"{base_topic}/zone/{zone_id}/setpoint",
-        "current_temperature_topic": f"{base_topic}/zone/{zone_id}/temp",
-        "fan_mode_command_topic": f"{base_topic}/zone/{zone_id}/set_fan_mode",
-        "fan_mode_state_topic": f"{base_topic}/zone/{zone_id}/fan_mode",
-        "preset_mode_command_topic": f"{base_topic}/zone/{zone_id}/set_preset_mode",
-        "preset_mode_state_topic": f"{base_topic}/zone/{zone_id}/preset_mode",
+        "mode_command_topic": f"{zone_topic}/set_mode",
+        "mode_state_topic": f"{zone_topic}/mode",
+        "temperature_command_topic": f"{zone_topic}/set_temp",
+        "temperature_state_topic": f"{zone_topic}/setpoint",
+        "current_temperature_topic": f"{zone_topic}/temp",
+        "fan_mode_command_topic": f"{zone_topic}/set_fan_mode",
+        "fan_mode_state_topic": f"{zone_topic}/fan_mode",
+        "preset_mode_command_topic": f"{zone_topic}/set_preset_mode",
+        "preset_mode_state_topic": f"{zone_topic}/preset_mode",
         "min_temp": 16.5,
         "max_temp": 30,
         "temp_step": 0.5,
@@ -110,47 +1682,59 @@ def publish_discovery(zone_id):
         "icon": "mdi:air-conditioner",
         "qos": 0
     }
-    climate_config["device"] = ZONE_DEVICE_INFO(zone_id, zone["name"])
+    climate_config["device"] = ZONE_DEVICE_INFO(ctl, zone_id, zone["name"])
+    use_state_document(climate_config, "mode_state_topic", "mode_state_template")
+    use_state_document(climate_config, "temperature_state_topic", "temperature_state_template")
+    use_state_document(climate_config, "current_temperature_topic", "current_temperature_template")
+    use_state_document(climate_config, "fan_mode_state_topic", "fan_mode_state_template")
+    use_state_document(climate_config, "preset_mode_state_topic", "preset_mode_value_template")
 
-    client.publish(f"{topic_prefix}/config", json.dumps(climate_config), retain=True)
+    configs = [(f"{topic_prefix}/config", climate_config)]
 
     damper_config = {
         "name": f"{zone['name']} Damper",
-        "unique_id": f"zity_zone_{zone_id}_damper",
-        "state_topic": f"{base_topic}/zone/{zone_id}/damper_status",
+        "unique_id": f"{object_id}_damper",
+        "state_topic": f"{zone_topic}/damper_status",
         "payload_on": "open",
         "payload_off": "closed",
         "device_class": "running"
     }
-    damper_config["device"] = ZONE_DEVICE_INFO(zone_id, zone["name"])
-    client.publish(f"homeassistant/binary_sensor/zity_zone_{zone_id}_damper/config", json.dumps(damper_config), retain=True)
+    damper_config["device"] = ZONE_DEVICE_INFO(ctl, zone_id, zone["name"])
+    use_state_document(damper_config, "state_topic", "value_template")
+    configs.append((f"homeassistant/binary_sensor/{object_id}_damper/config", damper_config))
 
     current_temp_config = {
         "name" : f"{zone['name']} Current Temperature",
-        "unique_id": f"zity_zone_{zone_id}_current_temperature",
-        "state_topic": f"{base_topic}/zone/{zone_id}/temp",
+        "unique_id": f"{object_id}_current_temperature",
+        "state_topic": f"{zone_topic}/temp",
         "device_class": "temperature",
         "unit_of_measurement": "°C",
     }
-    current_temp_config["device"] = ZONE_DEVICE_INFO(zone_id, zone["name"])
-    client.publish(f"homeassistant/sensor/zity_zone_{zone_id}_current_temperature/config", json.dumps(current_temp_config), retain=True)
+    current_temp_config["device"] = ZONE_DEVICE_INFO(ctl, zone_id, zone["name"])
+    use_state_document(current_temp_config, "state_topic", "value_template")
+    configs.append((f"homeassistant/sensor/{object_id}_current_temperature/config", current_temp_config))
 
     setpoint_config = {
         "name" : f"{zone['name']} Setpoint",
-        "unique_id": f"zity_zone_{zone_id}_setpoint",
-        "state_topic": f"{base_topic}/zone/{zone_id}/setpoint",
+        "unique_id": f"{object_id}_setpoint",
+        "state_topic": f"{zone_topic}/setpoint",
         "device_class": "temperature",
         "unit_of_measurement": "°C",
     }
-    setpoint_config["device"] = ZONE_DEVICE_INFO(zone_id, zone["name"])
-    client.publish(f"homeassistant/sensor/zity_zone_{zone_id}_setpoint/config", json.dumps(setpoint_config), retain=True)
+    setpoint_config["device"] = ZONE_DEVICE_INFO(ctl, zone_id, zone["name"])
+    use_state_document(setpoint_config, "state_topic", "value_template")
+    configs.append((f"homeassistant/sensor/{object_id}_setpoint/config", setpoint_config))
+
+    # The entities above show register values; they go unavailable while those fail.
+    for _, config_payload in configs:
+        config_payload["availability_topic"] = f"{zone_topic}/availability"
 
     # Manual Override Switch Discovery
     manual_override_config = {
         "name": f"{zone['name']} Manual Override",
-        "unique_id": f"zity_zone_{zone_id}_manual_override",
-        "state_topic": f"{base_topic}/zone/{zone_id}/manual_override",
-        "command_topic": f"{base_topic}/zone/{zone_id}/set_manual_override",
+        "unique_id": f"{object_id}_manual_override",
+        "state_topic": f"{zone_topic}/manual_override",
+        "command_topic": f"{zone_topic}/set_manual_override",
         "payload_on": "ON",
         "payload_off": "OFF",
         "state_on": "ON",
@@ -158,73 +1742,126 @@ def publish_discovery(zone_id):
         "icon": "mdi:account-edit",
         "optimistic": "false"
     }
-    manual_override_config["device"] = ZONE_DEVICE_INFO(zone_id, zone["name"])
-    client.publish(f"homeassistant/switch/zity_zone_{zone_id}_manual_override/config", json.dumps(manual_override_config), retain=True)
-
-def publish_system_discovery():
-    for key in system_registers:
-        topic = f"homeassistant/sensor/zity_system_{key}/config"
+    manual_override_config["device"] = ZONE_DEVICE_INFO(ctl, zone_id, zone["name"])
+    configs.append((f"homeassistant/switch/{object_id}_manual_override/config", manual_override_config))
+    return configs
+
+def system_discovery_configs(ctl):
+    """Return the (topic, payload) discovery configs of the system and alarm entities"""
+    configs = []
+    for key in ctl.system_registers:
+        topic = f"homeassistant/sensor/{ctl.id_prefix}_system_{key}/config"
         if "write" in key:
             continue
         config_payload = {
             "name": f"Zity System {key.replace('_', ' ').title()}",
-            "unique_id": f"zity_system_{key}",
-            "state_topic": f"{base_topic}/system/{key}",
+            "unique_id": f"{ctl.id_prefix}_system_{key}",
+            "state_topic": f"{ctl.base_topic}/system/{key}",
         }
         if "temp" in key or "setpoint" in key:
             config_payload["unit_of_measurement"] = "°C"
         if key == "power_mode":
-            config_payload["command_topic"] = f"{base_topic}/system/set_power"
+            config_payload["command_topic"] = f"{ctl.base_topic}/system/set_power"
             config_payload["payload_on"] = "on"
             config_payload["payload_off"] = "off"
-            topic = f"homeassistant/switch/zity_system_{key}/config"
+            topic = f"homeassistant/switch/{ctl.id_prefix}_system_{key}/config"
         if key == "controller_mode":
             config_payload["payload_on"] = "on"
             config_payload["payload_off"] = "off"
-            topic = f"homeassistant/binary_sensor/zity_system_{key}/config"
-        config_payload["device"] = SYSTEM_DEVICE_INFO
-        client.publish(topic, json.dumps(config_payload), retain=True)
+            topic = f"homeassistant/binary_sensor/{ctl.id_prefix}_system_{key}/config"
+        config_payload["device"] = SYSTEM_DEVICE_INFO(ctl)
+        use_state_document(config_payload, "state_topic", "value_template")
+        config_payload["availability_topic"] = f"{ctl.base_topic}/system/availability"
+        configs.append((topic, config_payload))
 
     select_config = {
         "name": "Zity System Mode",
-        "unique_id": "zity_system_mode_select",
-        "command_topic": f"{base_topic}/system/set_mode",
-        "state_topic": f"{base_topic}/system/mode",
+        "unique_id": f"{ctl.id_prefix}_system_mode_select",
+        "command_topic": f"{ctl.base_topic}/system/set_mode",
+        "state_topic": f"{ctl.base_topic}/system/mode",
         "options": ["off", "cool", "heat", "dry", "fan_only"],
         "optimistic": "true"
     }
-    select_config["device"] = SYSTEM_DEVICE_INFO
-    client.publish("homeassistant/select/zity_system_mode/config", json.dumps(select_config), retain=True)
+    select_config["device"] = SYSTEM_DEVICE_INFO(ctl)
+    use_state_document(select_config, "state_topic", "value_template")
+    select_config["availability_topic"] = f"{ctl.base_topic}/system/availability"
+    configs.append((f"homeassistant/select/{ctl.id_prefix}_system_mode/config", select_config))
 
-    for reg, name in alarm_registers.items():
+    for reg, name in ctl.alarm_registers.items():
         config = {
             "name": f"Zity Alarm – {name.replace('_', ' ').title()}",
-            "unique_id": f"zity_alarm_{name}",
-            "state_topic": f"{base_topic}/system/alarm_{reg}",
+            "unique_id": f"{ctl.id_prefix}_alarm_{name}",
+            "state_topic": f"{ctl.base_topic}/system/alarm_{reg}",
             "payload_on": "1",
             "payload_off": "0",
             "device_class": "problem"
         }
-        config["device"] = SYSTEM_DEVICE_INFO
-        client.publish(f"homeassistant/binary_sensor/zity_alarm_{name}/config", json.dumps(config), retain=True)
+        config["device"] = SYSTEM_DEVICE_INFO(ctl)
+        use_state_document(config, "state_topic", "value_template")
+        config["availability_topic"] = alarm_availability_topic(ctl, reg)
+        configs.append((f"homeassistant/binary_sensor/{ctl.id_prefix}_alarm_{name}/config", config))
+    return configs
+
+def content_hash(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+def build_discovery_messages():
+    """Serialize all discovery configs once; returns a dict of topic -> payload bytes"""
+    configs = []
+    for ctl in controllers:
+        for zone_id in ctl.zones:
+            configs += zone_discovery_configs(ctl, zone_id)
+        configs += system_discovery_configs(ctl)
+    return {topic: json.dumps(payload).encode() for topic, payload in configs}
+
+discovery_messages = build_discovery_messages()
+discovery_hashes = {topic: content_hash(payload) for topic, payload in discovery_messages.items()}
+discovery_counters = {"discovery_sent": 0, "discovery_skipped": 0}
+last_full_discovery = time.monotonic()
+
+def publish_discovery_messages(topics):
+    for topic in topics:
+        enqueue_publish(topic, discovery_messages[topic], priority=PUBLISH_BULK)
+    discovery_counters["discovery_sent"] += len(topics)
+    discovery_counters["discovery_skipped"] += len(discovery_messages) - len(topics)
+
+def announce_discovery():
+    """Publish the discovery configs the broker doesn't hold yet"""
+    global last_full_discovery
+    now = time.monotonic()
+    if now - last_full_discovery >= discovery_interval:
+        last_full_discovery = now
+        publish_discovery_messages(list(discovery_messages))
+        return
+
+    def compare(retained):
+        stale = [
+            topic for topic in discovery_messages
+            if topic not in retained or content_hash(retained[topic]) != discovery_hashes[topic]
+        ]
+        logger.info(f"Publishing {len(stale)} of {len(discovery_messages)} discovery config(s)")
+        publish_discovery_messages(stale)
+
+    probe_retained(discovery_messages, compare)
+
+def refresh_discovery():
+    """Publish all discovery configs again when discovery_interval has passed"""
+    global last_full_discovery
+    now = time.monotonic()
+    if discovery_interval and now - last_full_discovery >= discovery_interval and client.is_connected():
+        last_full_discovery = now
+        logger.info(f"Publishing all {len(discovery_messages)} discovery config(s)")
+        publish_discovery_messages(list(discovery_messages))
 
 # ------------------ Manual Override Functions ------------------ #
 
-def check_manual_override(zone_id, current_values):
+def check_manual_override(ctl, zone_id, current_values):
     """Check if manual override should be activated for a zone"""
-    global manual_override_states, last_mqtt_values
-
-    check_needed = True
-
-    # Aquire lock to make sure values are not being updated.
-    with state_lock:
-        if manual_override_states[zone_id]:
-            # Already in override mode, don't check
-            check_needed = False
-        last_values = last_mqtt_values[zone_id]
+    # A consistent snapshot; commands swap in new records rather than changing this one.
+    last_values = ctl.zone_states[zone_id]
 
     # If manual override is already active for the zone, don't check.
-    if not check_needed:
+    if last_values.manual_override:
         logger.info(f"Zone {zone_id}: Skipped; manual override already activated")
         return
 
@@ -232,377 +1869,1117 @@ def check_manual_override(zone_id, current_values):
     changes_detected = False
 
     # Check setpoint (temperature)
-    if (last_values['temp'] is not None and
+    if (last_values.temp is not None and
         current_values.get('setpoint') is not None and
-        float(current_values['setpoint']) != float(last_values['temp'])):
-        logger.info(f"Zone {zone_id}: Manual setpoint change detected: {last_values['temp']} -> {current_values['setpoint']}")
+        float(current_values['setpoint']) != float(last_values.temp)):
+        logger.info(f"Zone {zone_id}: Manual setpoint change detected: {last_values.temp} -> {current_values['setpoint']}")
         changes_detected = True
 
     # Check mode
-    if (last_values['mode'] is not None and
+    if (last_values.mode is not None and
         current_values.get('mode') is not None and
-        current_values['mode'] != last_values['mode']):
-        logger.info(f"Zone {zone_id}: Manual mode change detected: {last_values['mode']} -> {current_values['mode']}")
+        current_values['mode'] != last_values.mode):
+        logger.info(f"Zone {zone_id}: Manual mode change detected: {last_values.mode} -> {current_values['mode']}")
         changes_detected = True
 
     # Check fan mode
-    if (last_values['fan_mode'] is not None and
+    if (last_values.fan_mode is not None and
         current_values.get('fan_mode') is not None and
-        current_values['fan_mode'] != last_values['fan_mode']):
-        logger.info(f"Zone {zone_id}: Manual fan mode change detected: {last_values['fan_mode']} -> {current_values['fan_mode']}")
+        current_values['fan_mode'] != last_values.fan_mode):
+        logger.info(f"Zone {zone_id}: Manual fan mode change detected: {last_values.fan_mode} -> {current_values['fan_mode']}")
         changes_detected = True
 
     # Check preset mode
-    if (last_values['preset_mode'] is not None and
+    if (last_values.preset_mode is not None and
         current_values.get('preset_mode') is not None and
-        current_values['preset_mode'] != last_values['preset_mode']):
-        logger.info(f"Zone {zone_id}: Manual preset mode change detected: {last_values['preset_mode']} -> {current_values['preset_mode']}")
+        current_values['preset_mode'] != last_values.preset_mode):
+        logger.info(f"Zone {zone_id}: Manual preset mode change detected: {last_values.preset_mode} -> {current_values['preset_mode']}")
         changes_detected = True
 
     if changes_detected:
-        set_manual_override(zone_id, True)
+        set_manual_override(ctl, zone_id, True)
     else:
         logger.info(f"Zone {zone_id}: No manual changes detected")
 
-def set_manual_override(zone_id, state):
+def set_manual_override(ctl, zone_id, state):
     """Set manual override state for a zone"""
-
-    global manual_override_states, last_mqtt_values
-
-    # Acquire lock to make sure values are not being used anywhere else while we're updating.
-    with state_lock:
-        last_mqtt_values[zone_id]['reset'] = not(state)
-        manual_override_states[zone_id] = state
+    update_zone_state(ctl, zone_id, manual_override=state, reset=not state)
 
     payload = "ON" if state else "OFF"
-    client.publish(f"{base_topic}/zone/{zone_id}/manual_override", payload, retain=True)
+    enqueue_publish(manual_override_topic(ctl, zone_id), payload, priority=PUBLISH_COMMAND)
+    note_state(manual_override_topic(ctl, zone_id), payload)
     logger.info(f"Zone {zone_id}: Manual override set to {payload}")
 
-def load_retained_manual_override_states():
-    """Load retained manual override states from MQTT broker"""
-    def on_manual_override_message(client, userdata, msg):
-        try:
-            topic_parts = msg.topic.split('/')
-            zone_id = topic_parts[-2]  # Get zone_id from topic
-            if zone_id in zones:
-                payload = msg.payload.decode().upper()
-                manual_override_states[zone_id] = (payload == "ON")
-                logger.info(f"Zone {zone_id}: Loaded retained manual override state: {payload}")
-        except Exception as e:
-            logger.error(f"Error loading retained manual override state: {e}")
-
-    # Subscribe to all manual override topics to get retained messages
-    temp_client = mqtt.Client()
-    temp_client.username_pw_set(config["mqtt"]["username"], config["mqtt"]["password"])
-    temp_client.on_message = on_manual_override_message
+# ------------------ Retained messages ------------------ #
+
+# The manual override states and the discovery configs are read back from the
+# broker on the main connection: subscribe, collect the retained messages as the broker
+# sends them, and stop as soon as every topic has reported or retained_timeout passes.
+retained_timeout = startup_config.get("retained_timeout", 2)
+# The poller waits for the manual override states, but no longer than startup_timeout
+# seconds, so it still starts when the broker can't be reached.
+startup_timeout = startup_config.get("startup_timeout", 10)
+retained_probe_lock = threading.Lock()
+retained_probe = None
+retained_states_loaded = threading.Event()
+
+def call_later(delay, func, *args):
+    """Run func after delay seconds, on the event loop or on a timer thread"""
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(event_loop.call_later, delay, func, *args)
+    else:
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
+
+def probe_retained(topics, done):
+    """Collect the retained messages of topics, then call done(messages).
+
+    messages maps topic to payload; topics without a retained message are left out.
+    """
+    global retained_probe
+    probe = {"topics": set(topics), "messages": {}, "done": done}
+    with retained_probe_lock:
+        retained_probe = probe
+    for topic in probe["topics"]:
+        client.subscribe(topic)
+    call_later(retained_timeout, finish_retained_probe, probe)
+
+def on_retained_message(msg):
+    """Feed a message to the retained probe; returns True if the probe took it"""
+    with retained_probe_lock:
+        probe = retained_probe
+        if probe is None or msg.topic not in probe["topics"]:
+            return False
+        if msg.retain:
+            probe["messages"][msg.topic] = msg.payload
+        complete = len(probe["messages"]) == len(probe["topics"])
+    if complete:
+        finish_retained_probe(probe)
+    return True
+
+def finish_retained_probe(probe):
+    global retained_probe
+    with retained_probe_lock:
+        if retained_probe is not probe:
+            # Already finished, because all topics reported before the deadline.
+            return
+        retained_probe = None
+    for topic in probe["topics"]:
+        client.unsubscribe(topic)
+    logger.info(f"Received {len(probe['messages'])} of {len(probe['topics'])} retained message(s)")
+    probe["done"](probe["messages"])
+
+def manual_override_topic(ctl, zone_id):
+    return f"{ctl.base_topic}/zone/{zone_id}/manual_override"
 
-    try:
-        temp_client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], 60)
-        for zone_id in zones:
-            temp_client.subscribe(f"{base_topic}/zone/{zone_id}/manual_override")
-
-        # Wait briefly for retained messages
-        temp_client.loop_start()
-        time.sleep(2)
-        temp_client.loop_stop()
-        temp_client.disconnect()
-    except Exception as e:
-        logger.error(f"Error loading retained manual override states: {e}")
+def load_retained_manual_override_states():
+    """Load retained manual override states from MQTT broker, then start the bridge"""
+    def loaded(messages):
+        for ctl in controllers:
+            for zone_id in ctl.zones:
+                payload = messages.get(manual_override_topic(ctl, zone_id))
+                if payload is not None:
+                    payload = payload.decode().upper()
+                    update_zone_state(ctl, zone_id, manual_override=(payload == "ON"))
+                    logger.info(f"Zone {zone_id}: Loaded retained manual override state: {payload}")
+        subscribe_and_announce()
+        retained_states_loaded.set()
+
+    probe_retained([manual_override_topic(ctl, zone_id) for ctl in controllers for zone_id in ctl.zones], loaded)
 
 # ------------------ MQTT Event Handlers ------------------ #
 
 def on_connect(client, userdata, flags, rc):
     logger.info("Connected to MQTT broker.")
-
-    # Load retained manual override states first
-    load_retained_manual_override_states()
-
-    for zone_id in zones:
-        client.subscribe(f"{base_topic}/zone/{zone_id}/set_temp")
-        client.subscribe(f"{base_topic}/zone/{zone_id}/set_mode")
-        client.subscribe(f"{base_topic}/zone/{zone_id}/set_fan_mode")
-        client.subscribe(f"{base_topic}/zone/{zone_id}/set_preset_mode")
-        client.subscribe(f"{base_topic}/zone/{zone_id}/set_manual_override")
-        publish_discovery(zone_id)
-
-        # Publish initial manual override state
-        payload = "ON" if manual_override_states[zone_id] else "OFF"
-        client.publish(f"{base_topic}/zone/{zone_id}/manual_override", payload, retain=True)
-
-    client.subscribe(f"{base_topic}/system/set_mode")
-    client.subscribe(f"{base_topic}/system/set_power")
-    publish_system_discovery()
+    reset_inflight()
+
+    # The broker may have lost retained values while we were disconnected, so make
+    # sure the next poll publishes everything again. Values restored from the state
+    # file are trusted on the first connect.
+    if retained_states_loaded.is_set() or not state_restored:
+        clear_publish_cache()
+
+    # Load retained manual override states first, but only once: after a reconnect,
+    # our own states are the latest.
+    if retained_states_loaded.is_set():
+        subscribe_and_announce()
+    else:
+        load_retained_manual_override_states()
+
+def subscribe_and_announce():
+    """Subscribe to the command topics and publish discovery and manual override states"""
+    for topic in command_subscriptions:
+        client.subscribe(topic)
+    for ctl in controllers:
+        for zone_id in ctl.zones:
+            # Publish initial manual override state
+            payload = "ON" if ctl.zone_states[zone_id].manual_override else "OFF"
+            enqueue_publish(manual_override_topic(ctl, zone_id), payload)
+            note_state(manual_override_topic(ctl, zone_id), payload)
+    announce_discovery()
 
 def on_message(client, userdata, msg):
-    global last_mqtt_values
     topic = msg.topic
     payload = msg.payload.decode()
 
-    if topic == f"{base_topic}/system/set_mode":
-        try:
-            mb.write_registers(trigger_register, [1], slave=slave_id)
-            time.sleep(0.2)
-            if payload in state_list:
-                idx = state_list.index(payload)
-                # Changing registers and last_mqtt_values, so acquire lock
-                with state_lock:
-                    mb.write_registers(system_mode_write_register, [idx], slave=slave_id)
-                    client.publish(f"{base_topic}/system/mode", payload, retain=True)
-                    logger.info(f"System mode set to {payload}")
-                    # Update last_mqtt_values for all zones, but only if the zone is not "off"
-                    for zid in zones:
-                        if last_mqtt_values[zid]['mode'] != "off":
-                            last_mqtt_values[zid]['mode'] = payload
-                            last_mqtt_values[zid]['postpone'] = latency
-                            client.publish(f"{base_topic}/zone/{zid}/mode", payload, retain=True)
-                            logger.info(f"Zone {zid}: mode set to {payload}")
-                        else:
-                            logger.info(f"Zone {zid}: zone is switched off; remains off")
-        except Exception as e:
-            logger.error(f"Error setting system mode: {e}")
-        return
-    elif topic == f"{base_topic}/system/set_power":
-        try:
-            mb.write_registers(trigger_register, [1], slave=slave_id)
-            time.sleep(0.2)
-            value = 0 if payload == "off" else 1
-            mb.write_registers(system_power_mode_write_register, [value], slave=slave_id)
-            client.publish(f"{base_topic}/system/power_mode", payload, retain=True)
-            logger.info(f"System power mode set to {payload}")
-        except Exception as e:
-            logger.error(f"Error setting system power mode: {e}")
+    if on_retained_message(msg):
         return
 
-    zone_id = topic.split("/")[-2]
-    zone = zones.get(zone_id)
-    if not zone:
+    # The wildcard subscriptions also match zones and topics we don't know about.
+    route = command_routes.get(topic)
+    if route is None:
         return
-
-    # Handle manual override set commands. This does not require setting any registers
-    # so we handle this outside the try block.
-    if topic.endswith("/set_manual_override"):
-        state = payload.upper() == "ON"
-        set_manual_override(zone_id, state)
+    ctl, zone_id, parse, handler, on_bus = route
+    if capture_writer is not None:
+        capture_writer.record_message(topic, payload)
+    try:
+        value = parse(payload)
+    except (ValueError, KeyError):
+        logger.warning(f"{ctl.name}: ignoring invalid payload {payload!r} on {topic}")
+        inc_counter("zity_commands_rejected_total", (("controller", ctl.name),))
         return
 
+    # The manual override does not require setting any registers, so we handle this
+    # right away. Everything else needs the Modbus bus. Leave that to the bus worker, so
+    # the MQTT network loop never waits for the serial port.
+    if not on_bus:
+        execute_command(ctl, zone_id, handler, value)
+        return
+    submit_bus_job(
+        ctl.bus, COMMAND_PRIORITY, async_execute_command if event_loop else execute_command, ctl, zone_id, handler, value
+    )
+
+# ------------------ Commands ------------------ #
+
+# Every command has a handler, called with the parsed payload. Handlers run on the bus
+# worker, except the manual override, which runs on the MQTT network loop.
+
+def command_set_temp(ctl, zone_id, setpoint, overall_status):
+    zone = ctl.zones[zone_id]
+    value = int(setpoint * 10)
+    stage_write(ctl, zone["setpoint_write_register"], value)
+    # Store the MQTT value.
+    expect_readback(ctl, zone_id, "setpoint", value / 10.0, zone["setpoint_write_register"], value, temp=setpoint)
+    publish_state(f"{ctl.base_topic}/zone/{zone_id}/setpoint", setpoint, force=True)
+    logger.info(f"Zone {zone_id}: setpoint set to {setpoint}")
+
+def command_set_zone_mode(ctl, zone_id, on, overall_status):
+    """Switch a zone on or off; a zone that is on follows the overall system mode.
+
+    The asyncio runtime reads the overall system mode itself and passes it in as
+    overall_status; otherwise it is read here.
+    """
+    zone = ctl.zones[zone_id]
+    mode = "off"
+    if on:
+        if overall_status is None:
+            overall_status = cached_read(ctl, ctl.overall_status_register)
+        mode = state_list[overall_status]
+    stage_write(ctl, zone["status_write_register"], int(on))
+    # Store the MQTT value
+    expect_readback(ctl, zone_id, "mode", mode, zone["status_write_register"], int(on), mode=mode)
+    publish_state(f"{ctl.base_topic}/zone/{zone_id}/mode", mode, force=True)
+    logger.info(f"Zone {zone_id}: mode set to {mode}")
+
+def command_set_fan_mode(ctl, zone_id, value, overall_status):
+    zone = ctl.zones[zone_id]
+    fan_mode = fan_mode_list[value]
+    for zid, zconf in ctl.zones.items():
+        stage_config_write(ctl, zconf["master_slave_register"], 1 if zid == ctl.master_zone else 0)
+        stage_config_write(ctl, zconf["fan_control_register"], 1)
+    stage_write(ctl, zone["fan_mode_write_register"], value)
+    # Store the MQTT value
+    expect_readback(ctl, zone_id, "fan_mode", fan_mode, zone["fan_mode_write_register"], value, fan_mode=fan_mode)
+    publish_state(f"{ctl.base_topic}/zone/{zone_id}/fan_mode", fan_mode, force=True)
+    logger.info(f"Zone {zone_id}: fan mode set to {fan_mode}")
+
+def command_set_preset_mode(ctl, zone_id, value, overall_status):
+    zone = ctl.zones[zone_id]
+    preset_mode = "eco" if value else "none"
+    stage_write(ctl, zone["preset_mode_write_register"], value)
+    # Store the MQTT value
+    expect_readback(
+        ctl, zone_id, "preset_mode", preset_mode, zone["preset_mode_write_register"], value, preset_mode=preset_mode
+    )
+    publish_state(f"{ctl.base_topic}/zone/{zone_id}/preset_mode", preset_mode, force=True)
+    logger.info(f"Zone {zone_id}: preset mode set to {preset_mode}")
+
+def command_set_manual_override(ctl, zone_id, state, overall_status):
+    set_manual_override(ctl, zone_id, state)
+
+def command_set_system_mode(ctl, zone_id, idx, overall_status):
+    mode = state_list[idx]
+    stage_write(ctl, ctl.system_mode_write_register, idx)
+    publish_state(f"{ctl.base_topic}/system/mode", mode, force=True)
+    logger.info(f"System mode set to {mode}")
+    # Update the last MQTT values of all zones, but only if the zone is not "off"
+    for zid in ctl.zones:
+        if ctl.zone_states[zid].mode != "off":
+            expect_readback(ctl, zid, "mode", mode, ctl.system_mode_write_register, idx, mode=mode)
+            publish_state(f"{ctl.base_topic}/zone/{zid}/mode", mode, force=True)
+            logger.info(f"Zone {zid}: mode set to {mode}")
+        else:
+            logger.info(f"Zone {zid}: zone is switched off; remains off")
+
+def command_set_power(ctl, zone_id, on, overall_status):
+    payload = "on" if on else "off"
+    stage_write(ctl, ctl.system_power_mode_write_register, int(on))
+    publish_state(f"{ctl.base_topic}/system/power_mode", payload, force=True)
+    logger.info(f"System power mode set to {payload}")
+
+def command_set_scene(ctl, zone_id, changes, overall_status):
+    """Apply a scene: a list of (zone id, handler, value) changes, written as one batch"""
+    if overall_status is None and needs_overall_status(command_set_scene, changes):
+        overall_status = cached_read(ctl, ctl.overall_status_register)
+    for zid, handler, value in changes:
+        handler(ctl, zid, value, overall_status)
+    logger.info(f"Scene applied: {len(changes)} change(s) in {len({zid for zid, _, _ in changes})} zone(s)")
+
+def needs_overall_status(handler, value):
+    """Whether a command switches a zone on, which then follows the overall system mode"""
+    if handler is command_set_scene:
+        return any(needs_overall_status(zone_handler, zone_value) for _, zone_handler, zone_value in value)
+    return handler is command_set_zone_mode and value
+
+def execute_command(ctl, zone_id, handler, value, overall_status=None):
+    """Execute an MQTT command, then publish the state documents it changed"""
     try:
-        mb.write_registers(trigger_register, [1], slave=slave_id)
-        time.sleep(0.2)
-
-        if topic.endswith("/set_temp"):
-            value = int(float(payload) * 10)
-            with state_lock:
-                mb.write_registers(zone["setpoint_write_register"], [value], slave=slave_id)
-                # Store the MQTT value.
-                last_mqtt_values[zone_id]['temp'] = float(payload)
-                last_mqtt_values[zone_id]['postpone'] = latency
-            client.publish(f"{base_topic}/zone/{zone_id}/setpoint", payload, retain=True)
-            logger.info(f"Zone {zone_id}: setpoint set to {payload}")
-
-        elif topic.endswith("/set_mode"):
-            value = 0 if payload.lower() == "off" else 1
-            overall_status_result = mb.read_input_registers(overall_status_register, 1, slave=slave_id)
-            if payload.lower() != "off":
-                payload = state_list[overall_status_result.registers[0]]
-            with state_lock:
-                mb.write_registers(zone["status_write_register"], [value], slave=slave_id)
-                # Store the MQTT value
-                last_mqtt_values[zone_id]['mode'] = payload
-                last_mqtt_values[zone_id]['postpone'] = latency
-            client.publish(f"{base_topic}/zone/{zone_id}/mode", payload, retain=True)
-            logger.info(f"Zone {zone_id}: mode set to {payload}")
-        elif topic.endswith("/set_fan_mode"):
-            value = fan_mode_list.index(payload.lower())
-            for zid, zconf in zones.items():
-                mb.write_registers(zconf["master_slave_register"], [1 if zid == master_zone else 0], slave=slave_id)
-                time.sleep(0.1)
-                mb.write_registers(trigger_register, [1], slave=slave_id)
-                time.sleep(0.1)
-                mb.write_registers(zconf["fan_control_register"], [1], slave=slave_id)
-                time.sleep(0.1)
-                mb.write_registers(trigger_register, [1], slave=slave_id)
-            with state_lock:
-                mb.write_registers(zone["fan_mode_write_register"], [value], slave=slave_id)
-                # Store the MQTT value
-                last_mqtt_values[zone_id]['fan_mode'] = payload.lower()
-                last_mqtt_values[zone_id]['postpone'] = latency
-            client.publish(f"{base_topic}/zone/{zone_id}/fan_mode", payload.lower(), retain=True)
-            logger.info(f"Zone {zone_id}: fan mode set to {payload}")
-
-        elif topic.endswith("/set_preset_mode"):
-            value = 0 if payload.lower() == "none" else 1
-            with state_lock:
-                mb.write_registers(zone["preset_mode_write_register"], [value], slave=slave_id)
-                # Store the MQTT value
-                last_mqtt_values[zone_id]['preset_mode'] = payload
-                last_mqtt_values[zone_id]['postpone'] = latency
-            client.publish(f"{base_topic}/zone/{zone_id}/preset_mode", payload, retain=True)
-            logger.info(f"Zone {zone_id}: preset mode set to {payload}")
-
+        handler(ctl, zone_id, value, overall_status)
     except Exception as e:
         logger.error(f"MQTT message error: {e}")
+    publish_state_documents(PUBLISH_COMMAND)
+
+# ------------------ Command routing ------------------ #
+
+# Commands arrive on one wildcard subscription per command family, like
+# zity/zone/+/set_temp, so the number of subscriptions does not grow with the number of
+# zones. Controllers under the default <base_topic>/<name> prefix share a wildcard for
+# the controller level too, like zity/+/zone/+/set_temp, so neither do more
+# controllers; only a controller with a base_topic elsewhere adds its own.
+# (zity/zone/+/+ would also send every state the bridge publishes back to it.)
+# Incoming topics are routed with a single lookup in a dispatch table built once from
+# the config, and payloads are parsed with lookup tables prepared up front, so invalid
+# commands are dropped before they reach the bus queue.
+
+def lookup_parser(table):
+    """A payload parser accepting the keys of table, ignoring case and whitespace"""
+    def parse(payload):
+        return table[payload.strip().lower()]
+    return parse
+
+def parse_setpoint(payload):
+    setpoint = float(payload)
+    # Written the other way around, nan would pass.
+    if not 10 <= setpoint <= 50:
+        raise ValueError(f"setpoint {setpoint} out of range")
+    return setpoint
+
+parse_switch = lookup_parser({"off": False, "on": True})
+
+# command -> (payload parser, handler, runs on the bus worker)
+ZONE_COMMANDS = {
+    "set_temp": (parse_setpoint, command_set_temp, True),
+    "set_mode": (lookup_parser({mode: mode != "off" for mode in state_list if mode}), command_set_zone_mode, True),
+    "set_fan_mode": (lookup_parser({mode: index for index, mode in enumerate(fan_mode_list)}), command_set_fan_mode, True),
+    "set_preset_mode": (lookup_parser({"none": 0, "eco": 1}), command_set_preset_mode, True),
+    "set_manual_override": (parse_switch, command_set_manual_override, False),
+}
+SYSTEM_COMMANDS = {
+    "set_mode": (lookup_parser({mode: state_list.index(mode) for mode in state_list if mode}), command_set_system_mode, True),
+    "set_power": (parse_switch, command_set_power, True),
+}
+
+# A scene changes several zones at once, like {"1": {"setpoint": 19, "preset_mode": "eco"},
+# "2": {"mode": "off"}} on <base_topic>/scene/set. The whole scene is validated before
+# anything is written, and its writes go to the controller as one batch, with one
+# trigger write.
+SCENE_FIELDS = {"setpoint": "set_temp", "mode": "set_mode", "fan_mode": "set_fan_mode", "preset_mode": "set_preset_mode"}
+
+def scene_parser(ctl):
+    """A payload parser for the scenes of a controller"""
+    def parse(payload):
+        scene = json.loads(payload)
+        if not isinstance(scene, dict) or not scene:
+            raise ValueError("a scene is a JSON object of zones")
+        changes = []
+        for zone_id, fields in scene.items():
+            if zone_id not in ctl.zones or not isinstance(fields, dict):
+                raise ValueError(f"unknown zone {zone_id}")
+            for field, value in fields.items():
+                parse_field, handler, _ = ZONE_COMMANDS[SCENE_FIELDS[field]]
+                changes.append((zone_id, handler, parse_field(str(value))))
+        return changes
+    return parse
+
+def build_command_routes():
+    """Map every command topic to (controller, zone id, parser, handler, on_bus)"""
+    routes = {}
+    for ctl in controllers:
+        for zone_id in ctl.zones:
+            for command, (parse, handler, on_bus) in ZONE_COMMANDS.items():
+                routes[f"{ctl.base_topic}/zone/{zone_id}/{command}"] = (ctl, zone_id, parse, handler, on_bus)
+        for command, (parse, handler, on_bus) in SYSTEM_COMMANDS.items():
+            routes[f"{ctl.base_topic}/system/{command}"] = (ctl, None, parse, handler, on_bus)
+        routes[f"{ctl.base_topic}/scene/set"] = (ctl, None, scene_parser(ctl), command_set_scene, True)
+    return routes
+
+def subscription_prefix(ctl):
+    """The topic prefix the command subscriptions of a controller use"""
+    parent, _, _ = ctl.base_topic.rpartition("/")
+    return f"{base_topic}/+" if parent == base_topic else ctl.base_topic
+
+command_routes = build_command_routes()
+subscription_prefixes = {subscription_prefix(ctl) for ctl in controllers}
+command_subscriptions = sorted(
+    {f"{prefix}/zone/+/{command}" for prefix in subscription_prefixes for command in ZONE_COMMANDS}
+    | {f"{prefix}/system/{command}" for prefix in subscription_prefixes for command in SYSTEM_COMMANDS}
+    | {f"{prefix}/scene/set" for prefix in subscription_prefixes}
+)
 
 # ------------------ Polling ------------------ #
 
-def poll_zone_status():
-    global first_poll_completed
-    time.sleep(10)
-    while True:
-        if not mb.connected:
-            logger.info("Modbus disconnected. Trying to reconnect...")
-            try:
-                mb.connect()
-            except Exception as e:
-                logger.error(f"Reconnection failed: {e}")
-                time.sleep(5)
-                continue
+def process_poll_values(ctl, values, groups, zone_ids=None):
+    """Process register values after a poll: override checks and publishing.
+
+    values holds the current value of every register of the controller read so far,
+    without the registers that fail, groups the poll groups that were just read. Zone
+    settings are only processed when zone_settings was read; zone_ids limits that to
+    specific zones, for read-backs after a command. Fields whose registers are missing
+    are skipped; the rest of the zone is processed as usual. Returns False if the
+    system mode could not be read, in which case the zone modes were skipped.
+    """
+    read_temps = "zone_temps" in groups
+    read_settings = "zone_settings" in groups
+
+    mode_val = values.get(ctl.overall_status_register)
+    if read_settings and mode_val is None:
+        logger.error(f"{ctl.name}: error reading system mode")
+
+    for zone_id in (zone_ids or ctl.zones) if read_temps or read_settings else []:
+        zone = ctl.zones[zone_id]
+        zone_topic = f"{ctl.base_topic}/zone/{zone_id}"
         try:
-            with state_lock:
-                mode_val = mb.read_input_registers(system_registers["mode"], 1, slave=slave_id).registers[0]
-        except Exception as e:
-            logger.error(f"Error reading system mode: {e}")
-            time.sleep(5)
-            continue
+            raw = {key: values.get(zone[key]) for key in ZONE_READ_REGISTERS}
+            missing = sorted(key for key, value in raw.items() if value is None)
+            temp = raw["temp_read_register"] / 10.0 if raw["temp_read_register"] is not None else None
 
-        for zone_id, zone in zones.items():
-            try:
-                with state_lock:
-                    do_override_check = (last_mqtt_values[zone_id]['postpone'] == 0)
-                    temp = mb.read_input_registers(zone["temp_read_register"], 1, slave=slave_id).registers[0] / 10.0
-                    setpoint = mb.read_input_registers(zone["setpoint_read_register"], 1, slave=slave_id).registers[0] / 10.0
-                    damper = mb.read_input_registers(zone["damper_status_read_register"], 1, slave=slave_id).registers[0]
-                    power = mb.read_input_registers(zone["status_read_register"], 1, slave=slave_id).registers[0]
-                    fan_mode = mb.read_input_registers(zone["fan_mode_read_register"], 1, slave=slave_id).registers[0]
-                    preset_mode = mb.read_input_registers(zone["preset_mode_read_register"], 1, slave=slave_id).registers[0]
-
-                    mode = "off" if power == 0 else state_list[mode_val]
-                    fan_mode_str = fan_mode_list[fan_mode]
-                    preset_mode_str = "eco" if preset_mode else "none"
-
-                    # Prepare current values for manual override check
-                    current_values = {
-                        'setpoint': setpoint,
-                        'mode': mode,
-                        'fan_mode': fan_mode_str,
-                        'preset_mode': preset_mode_str
-                    }
-
-                    # On first poll, initialize last_mqtt_values with current values
-                    # This prevents false positives after restart.
-                    # Also do this if the manual override switch was reset to "off". In this case, we must
-                    # act as if the current values are the last ones sent through MQTT.
-                    if (not first_poll_completed  and temp > 10 and temp < 50 and setpoint > 10 and setpoint < 50) or (last_mqtt_values[zone_id]['reset']):
-                        last_mqtt_values[zone_id]['temp'] = setpoint
-                        last_mqtt_values[zone_id]['mode'] = mode
-                        last_mqtt_values[zone_id]['fan_mode'] = fan_mode_str
-                        last_mqtt_values[zone_id]['preset_mode'] = preset_mode_str
-                        last_mqtt_values[zone_id]['reset'] = False
-
-                # Check for manual override (only if values are valid, not first poll and not right after the zone was updated through MQTT)
-                if first_poll_completed and temp > 10 and temp < 50 and setpoint > 10 and setpoint < 50 and do_override_check:
-                    check_manual_override(zone_id, current_values)
-                elif not first_poll_completed:
-                    logger.info(f"Zone {zone_id}: Waiting for first poll to complete.")
-                elif do_override_check:
-                    logger.info(f"Zone {zone_id}: Invalid temperature or setpoint values found; skipping override check.")
-                else:
-                    with state_lock:
-                        waits = last_mqtt_values[zone_id]['postpone']
-                        logger.info(f"Zone {zone_id}: Manual override check postponed. Waits: {waits}.")
-                        last_mqtt_values[zone_id]['postpone'] -= 1
+            if read_temps:
+                damper = raw["damper_status_read_register"]
 
                 # Publish the values we cannot change through MQTT.
 
                 # Sometimes, right after (re-) starting the Zity, it comes up with incorrect values. Don't publish these.
-                if temp > 10 and temp < 50:
-                    client.publish(f"{base_topic}/zone/{zone_id}/temp", temp, retain=True)
-                client.publish(f"{base_topic}/zone/{zone_id}/damper_status", "open" if damper else "closed", retain=True)
+                if temp is not None and temp > 10 and temp < 50:
+                    publish_state(f"{zone_topic}/temp", temp, deadband=temp_deadband)
+                if damper is not None:
+                    publish_state(f"{zone_topic}/damper_status", "open" if damper else "closed")
+                logger.debug(f"Zone {zone_id} status: temp '{temp}', damper '{damper}'")
 
-                # Only publish the values that can be changed if there were no recent MQTT changes. This gives the Zity
-                # some time to propagate the settings from the write to the read registers. Otherwise, this might publish
-                # one or more older values.
+            if not read_settings:
+                continue
 
-                if do_override_check:
+            state = ctl.zone_states[zone_id]
+            setpoint = raw["setpoint_read_register"] / 10.0 if raw["setpoint_read_register"] is not None else None
+            power = raw["status_read_register"]
+            fan_mode = raw["fan_mode_read_register"]
+            preset_mode = raw["preset_mode_read_register"]
+
+            # Prepare current values for manual override check, leaving out the fields we could not read
+            current_values = {}
+            if setpoint is not None:
+                current_values['setpoint'] = setpoint
+            if power is not None and (power == 0 or mode_val is not None):
+                current_values['mode'] = "off" if power == 0 else state_list[mode_val]
+            if fan_mode is not None:
+                current_values['fan_mode'] = fan_mode_list[fan_mode]
+            if preset_mode is not None:
+                current_values['preset_mode'] = "eco" if preset_mode else "none"
+            if missing:
+                logger.warning(f"Zone {zone_id}: no current value of {', '.join(missing)}; skipping those fields")
+            # Fields changed through MQTT are left alone until the controller confirms them.
+            pending = confirm_pending_writes(ctl, zone_id, current_values)
+            settled_values = {field: value for field, value in current_values.items() if field not in pending}
+            # Weird temperatures or setpoints mean the controller has just (re-) started.
+            plausible = all(value > 10 and value < 50 for value in (temp, setpoint) if value is not None)
+
+            # On first poll, initialize the last MQTT values with current values
+            # This prevents false positives after restart.
+            # Also do this if the manual override switch was reset to "off". In this case, we must
+            # act as if the current values are the last ones sent through MQTT.
+            # Fields that could not be read before are initialized when they are first read.
+            baseline = {
+                FIELD_STATE_NAMES[field]: value for field, value in current_values.items()
+                if (not ctl.first_poll_completed and plausible) or state.reset
+                or (plausible and getattr(state, FIELD_STATE_NAMES[field]) is None)
+            }
+            if baseline or state.reset:
+                update_zone_state(ctl, zone_id, reset=False, **baseline)
+
+            # Check for manual override (only if values are valid, not first poll and only the confirmed fields)
+            if ctl.first_poll_completed and plausible:
+                check_manual_override(ctl, zone_id, settled_values)
+            elif not ctl.first_poll_completed:
+                logger.info(f"Zone {zone_id}: Waiting for first poll to complete.")
+            else:
+                logger.info(f"Zone {zone_id}: Invalid temperature or setpoint values found; skipping override check.")
+
+            # Only publish the values that can be changed once the controller reports what was written through
+            # MQTT. Until then, the read registers may still hold the older values.
+            if pending:
+                logger.info(f"Zone {zone_id}: Waiting for confirmation of {', '.join(sorted(pending))}. Values in dict: {current_values}.")
+            logger.debug(f"Zone {zone_id}: Publishing values.")
+            if "setpoint" in settled_values and setpoint > 10 and setpoint < 50:
+                publish_state(f"{zone_topic}/setpoint", setpoint)
+            if "mode" in settled_values:
+                publish_state(f"{zone_topic}/power", "on" if power else "off")
+                publish_state(f"{zone_topic}/mode", settled_values["mode"])
+            if "fan_mode" in settled_values:
+                publish_state(f"{zone_topic}/fan_mode", settled_values["fan_mode"])
+            if "preset_mode" in settled_values:
+                publish_state(f"{zone_topic}/preset_mode", settled_values["preset_mode"])
+
+            logger.debug(f"Zone {zone_id} status: setpoint '{setpoint}', power '{power}', fan_mode '{fan_mode}', preset_mode '{preset_mode}', values {current_values}")
 
-                    logger.info(f"Zone {zone_id}: Publishing values.")
-                    if setpoint > 10 and setpoint < 50:
-                        client.publish(f"{base_topic}/zone/{zone_id}/setpoint", setpoint, retain=True)
-                    client.publish(f"{base_topic}/zone/{zone_id}/power", "on" if power else "off", retain=True)
-                    client.publish(f"{base_topic}/zone/{zone_id}/mode", mode, retain=True)
-                    client.publish(f"{base_topic}/zone/{zone_id}/fan_mode", fan_mode_str, retain=True)
-                    client.publish(f"{base_topic}/zone/{zone_id}/preset_mode", preset_mode_str, retain=True)
-                else:
-                    logger.info(f"Zone {zone_id}: Postponing MQTT messages. Values in dict: {current_values}.")
 
-                logger.debug(f"Zone {zone_id} status: setpoint '{setpoint}', damper '{damper}', power '{power}', mode '{mode}', fan_mode '{fan_mode}', fan_mode_str '{fan_mode_str}', preset_mode '{preset_mode}', preset_mode_str '{preset_mode_str}'")
+        except Exception as e:
+            logger.error(f"Polling error in zone {zone_id}: {e}")
 
+    # Mark first poll as completed after processing all zones
+    if read_settings and zone_ids is None and not ctl.first_poll_completed:
+        ctl.first_poll_completed = True
+        logger.info(f"{ctl.name}: first poll completed - manual override detection now active")
 
-            except Exception as e:
-                logger.error(f"Polling error in zone {zone_id}: {e}")
+    # System-level registers
+    for key, reg in ctl.system_registers.items() if "system" in groups else []:
+        if "write" in key:
+            continue
+        try:
+            val = values[reg]
+            if "temp" in key:
+                val = val / 10.0
+                # Prevent weird values (could occur just after startup).
+                # Just assume it's 21 in that case.
+                if val < 10 or val > 50:
+                    val = 21
+            elif key == "setpoint":
+                if val < 10 or val > 50:
+                    val = 21
+            elif key == "mode":
+                index = val
+                val = state_list[0]
+                val = state_list[index]
+            elif key == "power_mode" or key == "controller_mode":
+                val = "on" if val == 1 else "off"
+            elif "flexi" in key:
+                index = val
+                val = fan_mode_list[0]
+                val = fan_mode_list[index]
+            elif key == "fan_speed":
+                index = val
+                val = system_fan_mode_list[0]
+                val = system_fan_mode_list[index]
+            publish_state(f"{ctl.base_topic}/system/{key}", val, deadband=temp_deadband if "temp" in key else 0)
+            logger.debug(f"System-level register {key}: {val}")
+        except Exception as e:
+            logger.error(f"{ctl.name}: system read error {key}: {e}")
 
-        # Mark first poll as completed after processing all zones
-        if not first_poll_completed:
-            first_poll_completed = True
-            logger.info("First poll completed - manual override detection now active")
+    # Alarms
+    for reg, name in ctl.alarm_registers.items() if "alarms" in groups else []:
+        try:
+            val = values[reg]
+            publish_state(f"{ctl.base_topic}/system/alarm_{reg}", str(val))
+        except Exception as e:
+            logger.error(f"{ctl.name}: alarm read error {reg}: {e}")
+
+    return not read_settings or mode_val is not None
+
+# ------------------ Poll scheduler ------------------ #
+
+# Every poll group has its own interval. When a group's values did not change since
+# the previous read, its interval is doubled, up to max_backoff times the configured
+# interval; any change resets it. After a command, the registers of the fields it
+# changed are read back every readback_interval seconds until the controller confirms
+# the new values, instead of waiting for the next poll of all zone settings. Every
+# controller has its own poller and schedule.
+polling_config = config.get("polling", {})
+poll_intervals = {"zone_temps": 30, "zone_settings": 30, "system": 60, "alarms": 300}
+poll_intervals.update(polling_config.get("intervals", {}))
+max_backoff = polling_config.get("max_backoff", 4)
+readback_interval = polling_config.get("readback_interval", 1)
+stats_interval = polling_config.get("stats_interval", 60)
+
+for ctl in controllers:
+    ctl.poll_groups = {
+        name: {
+            "registers": addresses,
+            "backoff": 1,
+            "next_due": 0,
+            "snapshot": None,
+            "duration": 0.0
+        } for name, addresses in ctl.poll_group_registers.items()
+    }
+readbacks_lock = threading.Lock()
+# The pollers of all controllers share the stats topic and the state file.
+housekeeping_lock = threading.Lock()
+next_stats = 0
+last_publish_count = (time.monotonic(), 0)
+
+def request_readback(ctl, zone_id):
+    """Read back a zone's settings soon, because a command changed them"""
+    with readbacks_lock:
+        ctl.readbacks[zone_id] = time.monotonic() + readback_interval
+        ctl.poll_groups["zone_settings"]["backoff"] = 1
+    wake_poller(ctl)
+
+def wake_poller(ctl):
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(ctl.poll_wakeup.set)
+    else:
+        ctl.poll_wakeup.set()
+
+def due_poll_work(ctl):
+    """Return the poll groups and zone read-backs that are due, and the registers to read"""
+    now = time.monotonic()
+    groups = [name for name, group in ctl.poll_groups.items() if group["next_due"] <= now]
+    with readbacks_lock:
+        zone_ids = [zone_id for zone_id, due in ctl.readbacks.items() if due <= now]
+        for zone_id in zone_ids:
+            del ctl.readbacks[zone_id]
+    if "zone_settings" in groups:
+        # A full read of the zone settings covers the read-backs too.
+        zone_ids = []
+    addresses = set()
+    for name in groups:
+        addresses.update(ctl.poll_groups[name]["registers"])
+    addresses -= fresh_registers(ctl, addresses)
+    for zone_id in zone_ids:
+        zone = ctl.zones[zone_id]
+        pending = ctl.zone_states[zone_id].pending
+        addresses.update(zone[FIELD_READ_REGISTERS[field]] for field in pending)
+        if "mode" in pending:
+            addresses.add(ctl.overall_status_register)
+        # Registers that were never read yet, like before the first poll, are read as well.
+        addresses.update(
+            address for address in [zone[key] for key in ZONE_READ_REGISTERS] + [ctl.overall_status_register]
+            if address not in ctl.register_values
+        )
+    return groups, zone_ids, skip_tripped_registers(ctl, addresses)
+
+def finish_poll_work(ctl, groups, zone_ids, values, failed, duration):
+    """Process what was read and schedule the next reads"""
+    record_register_health(ctl, values, failed)
+    cache_registers(ctl, values)
+    now = time.monotonic()
+    ok = True
+    if groups:
+        ok = process_poll_values(ctl, current_register_values(ctl), groups)
+    if groups:
+        observe("zity_poll_duration_seconds", duration)
+    for name in groups:
+        group = ctl.poll_groups[name]
+        group["duration"] = duration
+        snapshot = {address: ctl.register_values.get(address) for address in group["registers"]}
+        if not ok:
+            group["next_due"] = now + 5
+            continue
+        if snapshot == group["snapshot"]:
+            group["backoff"] = min(group["backoff"] * 2, max_backoff)
+        else:
+            group["backoff"] = 1
+        group["snapshot"] = snapshot
+        group["next_due"] = now + poll_intervals[name] * group["backoff"]
+
+    for zone_id in zone_ids:
+        process_poll_values(ctl, current_register_values(ctl), ["zone_settings"], [zone_id])
+    # Keep reading back until all writes of a zone are confirmed.
+    for zone_id, state in ctl.zone_states.items():
+        if state.pending:
+            with readbacks_lock:
+                ctl.readbacks.setdefault(zone_id, now + readback_interval)
+
+    publish_state_documents()
+    housekeeping()
+
+def housekeeping():
+    """Publish the bridge stats and discovery configs when they are due and save the state file"""
+    global next_stats
+    with housekeeping_lock:
+        now = time.monotonic()
+        if now >= next_stats:
+            publish_bridge_stats()
+            next_stats = now + stats_interval
+        refresh_discovery()
+        save_state_snapshot()
+        if capture_writer is not None:
+            capture_writer.flush()
+
+def next_poll_wakeup(ctl):
+    """Seconds until the poller of a controller has something to do"""
+    with readbacks_lock:
+        due = min([group["next_due"] for group in ctl.poll_groups.values()] + list(ctl.readbacks.values()) + [next_stats])
+    return max(0, due - time.monotonic())
+
+def poll_group_stats(ctl):
+    return {
+        name: {
+            "interval": poll_intervals[name] * group["backoff"],
+            "duration": round(group["duration"], 3)
+        } for name, group in ctl.poll_groups.items()
+    }
 
-        # System-level registers
-        for key, reg in system_registers.items():
-            if "write" in key:
-                continue
+def poll_zone_status(ctl):
+    # Don't poll before the manual override states are known.
+    retained_states_loaded.wait(startup_timeout)
+    mb = ctl.bus.client
+    while True:
+        if not mb.connected:
+            logger.info(f"{ctl.name}: Modbus disconnected. Trying to reconnect...")
             try:
-                val = mb.read_input_registers(reg, 1, slave=slave_id).registers[0]
-                if "temp" in key:
-                    val = val / 10.0
-                    # Prevent weird values (could occur just after startup).
-                    # Just assume it's 21 in that case.
-                    if val < 10 or val > 50:
-                        val = 21
-                elif key == "setpoint":
-                    if val < 10 or val > 50:
-                        val = 21
-                elif key == "mode":
-                    index = val
-                    val = state_list[0]
-                    val = state_list[index]
-                elif key == "power_mode" or key == "controller_mode":
-                    val = "on" if val == 1 else "off"
-                elif "flexi" in key:
-                    index = val
-                    val = fan_mode_list[0]
-                    val = fan_mode_list[index]
-                elif key == "fan_speed":
-                    index = val
-                    val = system_fan_mode_list[0]
-                    val = system_fan_mode_list[index]
-                client.publish(f"{base_topic}/system/{key}", val, retain=True)
-                logger.debug(f"System-level register {key}: {val}")
+                connected = run_on_bus(ctl.bus, mb.connect)
             except Exception as e:
-                logger.error(f"System read error {key}: {e}")
+                logger.error(f"{ctl.name}: reconnection failed: {e}")
+                connected = False
+            if not connected:
+                time.sleep(ctl.bus.reconnect_failed())
+                continue
+            ctl.bus.reconnected()
+            forget_config_written(ctl)
+        groups, zone_ids, addresses = due_poll_work(ctl)
+        if groups or addresses:
+            started = time.monotonic()
+            # Read everything that is due in as few block reads as possible. All of it
+            # may be in the register cache.
+            values, failed = read_planned_registers(ctl, read_plan_for(addresses, failing_registers(ctl))) if addresses else ({}, set())
+            finish_poll_work(ctl, groups, zone_ids, values, failed, time.monotonic() - started)
+        ctl.poll_wakeup.wait(next_poll_wakeup(ctl))
+        ctl.poll_wakeup.clear()
+
+# ------------------ Asyncio runtime ------------------ #
+
+# With "runtime: asyncio" in the config, the bridge runs as a set of tasks on a single
+# event loop instead of threads: a worker per bus, a poller per controller and the MQTT
+# connection. The Modbus clients are pymodbus's async clients, and paho's network loop
+# is driven by the event loop through its socket callbacks. The command and polling
+# logic itself is shared with the threaded runtime; only the parts that do I/O have
+# async counterparts.
+
+async def async_bus_worker(bus):
+    while True:
+        priority, _, queued_at, func, args, future = await bus.queue.get()
+        started = time.monotonic()
+        try:
+            future.set_result(await func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        record_bus_time(bus, time.monotonic() - started)
+        record_job_timing(priority, started - queued_at, time.monotonic() - started)
+
+async def async_run_on_bus(bus, func, *args):
+    return await asyncio.wrap_future(submit_bus_job(bus, POLL_PRIORITY, func, *args))
+
+async def async_perform_step(ctl, step):
+    """Asyncio counterpart of perform_step"""
+    kind, *args = step
+    if kind == "read":
+        return await async_read_block(ctl, *args)
+    if kind == "write":
+        return await async_write_block(ctl, *args)
+    if kind == "sleep":
+        return await asyncio.sleep(*args)
+    return await ctl.bus.client.connect()
+
+async def async_run_steps(steps, perform):
+    """Asyncio counterpart of run_steps; perform is a coroutine function"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await perform(step), None
+        except Exception as e:
+            result, error = None, e
 
-        # Alarms
-        for reg, name in alarm_registers.items():
-            try:
-                val = mb.read_input_registers(reg, 1, slave=slave_id).registers[0]
-                client.publish(f"{base_topic}/system/alarm_{reg}", str(val), retain=True)
-            except Exception as e:
-                logger.error(f"Alarm read error {reg}: {e}")
+async def async_read_block(ctl, start, count, holding=False):
+    read = ctl.bus.client.read_holding_registers if holding else ctl.bus.client.read_input_registers
+    await asyncio.sleep(ctl.bus.request_gap())
+    started = time.monotonic()
+    try:
+        registers = check_read_result(await read(start, count, slave=ctl.slave_id), start, count)
+    except Exception as e:
+        record_modbus_request(ctl, "read", start, time.monotonic() - started, e)
+        raise
+    record_modbus_request(ctl, "read", start, time.monotonic() - started)
+    return registers
+
+async def async_cached_read(ctl, address):
+    """Asyncio counterpart of cached_read"""
+    if fresh_registers(ctl, [address]):
+        return ctl.register_values[address]
+    value = (await async_read_block(ctl, address, 1))[0]
+    cache_registers(ctl, {address: value})
+    return value
+
+async def async_write_block(ctl, start, values):
+    await asyncio.sleep(ctl.bus.request_gap())
+    started = time.monotonic()
+    try:
+        check_write_result(await ctl.bus.client.write_registers(start, values, slave=ctl.slave_id), start, len(values))
+    except Exception as e:
+        record_modbus_request(ctl, "write", start, time.monotonic() - started, e)
+        raise
+    record_modbus_request(ctl, "write", start, time.monotonic() - started)
+
+async def async_read_pipelined(ctl, plan):
+    """Send the block reads of a plan with up to pipeline requests in flight.
+
+    Returns the registers of every block, or the exception its read raised.
+    """
+    in_flight = asyncio.Semaphore(ctl.bus.pipeline)
+
+    async def read(start, count):
+        async with in_flight:
+            return await async_read_block(ctl, start, count)
+
+    return await asyncio.gather(*(read(start, count) for start, count, _ in plan), return_exceptions=True)
+
+async def async_read_planned_registers(ctl, plan):
+    """Asyncio counterpart of read_planned_registers"""
+    prefetched = {}
+    if ctl.bus.pipeline > 1:
+        # The whole plan is one bus job; the gateway puts the requests on its bus in turn.
+        results = await async_run_on_bus(ctl.bus, async_read_pipelined, ctl, plan)
+        prefetched = {("read", start, count, False): result for (start, count, _), result in zip(plan, results)}
+
+    async def perform(step):
+        if step in prefetched:
+            result = prefetched.pop(step)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return await async_run_on_bus(ctl.bus, async_perform_step, ctl, step)
+
+    return await async_run_steps(read_plan_steps(ctl, plan), perform)
+
+async def async_flush_writes(ctl):
+    """Asyncio counterpart of flush_writes"""
+    await async_run_steps(flush_steps(ctl), lambda step: async_perform_step(ctl, step))
+
+async def async_execute_command(ctl, zone_id, handler, value):
+    """Asyncio counterpart of execute_command"""
+    overall_status = None
+    if needs_overall_status(handler, value):
+        try:
+            overall_status = await async_cached_read(ctl, ctl.overall_status_register)
+        except Exception as e:
+            logger.error(f"MQTT message error: {e}")
+            return
+    execute_command(ctl, zone_id, handler, value, overall_status)
 
-        time.sleep(30)
+async def async_poll_zone_status(ctl):
+    try:
+        await asyncio.wait_for(retained_states_loaded.wait(), startup_timeout)
+    except asyncio.TimeoutError:
+        pass
+    mb = ctl.bus.client
+    while True:
+        if not mb.connected:
+            logger.info(f"{ctl.name}: Modbus disconnected. Trying to reconnect...")
+            if not await mb.connect():
+                logger.error(f"{ctl.name}: reconnection failed")
+                await asyncio.sleep(ctl.bus.reconnect_failed())
+                continue
+            ctl.bus.reconnected()
+            forget_config_written(ctl)
+        groups, zone_ids, addresses = due_poll_work(ctl)
+        if groups or addresses:
+            started = time.monotonic()
+            values, failed = (
+                await async_read_planned_registers(ctl, read_plan_for(addresses, failing_registers(ctl))) if addresses else ({}, set())
+            )
+            finish_poll_work(ctl, groups, zone_ids, values, failed, time.monotonic() - started)
+        try:
+            await asyncio.wait_for(ctl.poll_wakeup.wait(), next_poll_wakeup(ctl))
+        except asyncio.TimeoutError:
+            pass
+        ctl.poll_wakeup.clear()
+
+def attach_mqtt_to_event_loop(disconnected):
+    """Let the event loop drive paho's network loop through its socket callbacks"""
+    misc_task = None
+
+    async def misc_loop():
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def on_socket_open(client, userdata, sock):
+        nonlocal misc_task
+        event_loop.add_reader(sock, client.loop_read)
+        misc_task = event_loop.create_task(misc_loop())
+
+    def on_socket_close(client, userdata, sock):
+        event_loop.remove_reader(sock)
+        if misc_task is not None:
+            misc_task.cancel()
+
+    def on_socket_register_write(client, userdata, sock):
+        event_loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(client, userdata, sock):
+        event_loop.remove_writer(sock)
+
+    def on_disconnect(client, userdata, rc):
+        disconnected.set()
+
+    client.on_socket_open = on_socket_open
+    client.on_socket_close = on_socket_close
+    client.on_socket_register_write = on_socket_register_write
+    client.on_socket_unregister_write = on_socket_unregister_write
+    client.on_disconnect = on_disconnect
+
+async def async_mqtt_connection():
+    disconnected = asyncio.Event()
+    attach_mqtt_to_event_loop(disconnected)
+    while True:
+        disconnected.clear()
+        try:
+            client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], 60)
+            await disconnected.wait()
+            logger.error("MQTT connection lost. Reconnecting in 5s...")
+        except Exception as e:
+            logger.error(f"MQTT connection lost: {e}. Reconnecting in 5s...")
+        await asyncio.sleep(5)
+
+async def async_main():
+    global event_loop, retained_states_loaded, publish_wakeup
+    event_loop = asyncio.get_running_loop()
+    retained_states_loaded = asyncio.Event()
+    publish_wakeup = asyncio.Event()
+    for bus in buses.values():
+        bus.client = create_modbus_client(bus, asynchronous=True)
+        bus.queue = asyncio.PriorityQueue()
+        await bus.client.connect()
+    for ctl in controllers:
+        ctl.poll_wakeup = asyncio.Event()
+
+    await asyncio.gather(
+        *(async_bus_worker(bus) for bus in buses.values()),
+        async_mqtt_connection(),
+        async_publish_worker(),
+        *(async_poll_zone_status(ctl) for ctl in controllers),
+        *([async_replay_commands()] if replay is not None else [])
+    )
+
+# ------------------ Bus tuning ------------------ #
+
+# "python zity-mqtt-bridge.py tune" measures the Modbus bus instead of running the
+# bridge. For every combination of read block size, gap, response timeout and delay
+# between requests, it reads all polled registers of the controllers on each bus a few
+# times, without retries, and reports the throughput, the request latencies and the
+# error rate. The block size, gap and delay of the fastest combination without errors
+# are written to a config fragment, to merge into zity_config.yaml, with the shortest
+# timeout that had no failures with them. A dead thermostat costs a timeout in every
+# read, so the timeout should be no longer than the bus needs. With --simulator, the
+# buses are pointed at simulated controllers from zity_simulator.py.
+
+def number_list(text):
+    return [float(value) for value in text.split(",")]
+
+def gap_list(text):
+    return [int(value) for value in text.split(",")]
+
+def block_size_list(text):
+    sizes = [int(value) for value in text.split(",")]
+    if not all(1 <= size <= 125 for size in sizes):
+        raise argparse.ArgumentTypeError("Modbus reads are limited to 125 registers")
+    return sizes
+
+def tune_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog="zity-mqtt-bridge.py tune", description="Measure the Modbus bus and recommend its settings"
+    )
+    parser.add_argument("--block-sizes", type=block_size_list, default="8,16,32,64,125", help="max_block_size values to try")
+    parser.add_argument("--gaps", type=gap_list, default="0,4,8", help="max_gap values to try")
+    parser.add_argument("--timeouts", type=number_list, default="0.1,0.25,0.5,1", help="response timeouts to try, in seconds")
+    parser.add_argument("--delays", type=number_list, default="0,0.005,0.02", help="request_delay values to try, in seconds")
+    parser.add_argument("--cycles", type=int, default=3, help="reads of all polled registers per combination")
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="highest error rate that counts as reliable")
+    parser.add_argument("--output", default="zity_tune.yaml", help="the config fragment to write")
+    parser.add_argument("--simulator", action="store_true", help="tune against simulated controllers")
+    return parser.parse_args(argv)
+
+def start_tune_simulator():
+    """Serve a simulated controller for every bus, and point the bus at it"""
+    import zity_simulator
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    for bus in buses.values():
+        ctl = next(ctl for ctl in controllers if ctl.bus is bus)
+        zity = zity_simulator.Zity({
+            "modbus": bus.config, "zones": ctl.zones, "trigger_register": ctl.trigger_register,
+            "system_registers": ctl.system_registers, "alarm_registers": ctl.alarm_registers
+        }, baudrate=bus.config.get("baudrate", 9600))
+
+        async def serve():
+            if bus.transport == "serial":
+                return dict(port=zity_simulator.serve_pty(zity, loop))
+            framing = "tcp" if bus.transport == "tcp" else "rtu"
+            return dict(host="127.0.0.1", port=await zity_simulator.serve_tcp(zity, framing=framing))
+
+        bus.config = dict(bus.config, **asyncio.run_coroutine_threadsafe(serve(), loop).result())
+        bus.name = bus_name(bus.config)
+
+def measure_bus_settings(bus, block_size, gap_size, timeout, delay, cycles):
+    """Read the polled registers of every controller on a bus cycles times, and measure that"""
+    plans = [
+        (ctl, plan_block_reads(set().union(*ctl.poll_group_registers.values()), block_size=block_size, gap_size=gap_size))
+        for ctl in controllers if ctl.bus is bus
+    ]
+    bus.client = create_modbus_client(Bus(dict(bus.config, timeout=timeout, retries=0)))
+    bus.request_delay = delay
+    latencies = []
+    errors = 0
+    registers = 0
+    bus.client.connect()
+    started = time.monotonic()
+    try:
+        for _ in range(cycles):
+            for ctl, plan in plans:
+                for start, count, wanted in plan:
+                    request_started = time.monotonic()
+                    try:
+                        read_block(ctl, start, count)
+                        registers += len(wanted)
+                    except Exception:
+                        errors += 1
+                    latencies.append(time.monotonic() - request_started)
+    finally:
+        bus.client.close()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        "block_size": block_size, "gap": gap_size, "timeout": timeout, "delay": delay, "errors": errors,
+        "throughput": registers / elapsed, "cycle": elapsed / cycles,
+        "p50": latencies[len(latencies) // 2], "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "max": latencies[-1], "error_rate": errors / len(latencies)
+    }
+
+def recommend_bus_settings(results, max_error_rate):
+    """The settings of the fastest reliable combination, or None if nothing was reliable"""
+    reliable = [result for result in results if result["error_rate"] <= max_error_rate]
+    if not reliable:
+        return None
+    best = max(reliable, key=lambda result: result["throughput"])
+    # The shortest timeout that never expired with the same block size, gap and delay.
+    flawless = [
+        result["timeout"] for result in results
+        if (result["block_size"], result["gap"], result["delay"]) == (best["block_size"], best["gap"], best["delay"])
+        and result["errors"] == 0
+    ]
+    return {
+        "max_block_size": best["block_size"], "max_gap": best["gap"],
+        "timeout": min(flawless) if flawless else best["timeout"], "request_delay": best["delay"]
+    }
+
+def write_tune_fragment(path, recommended):
+    """Write the recommended settings of every bus as a config fragment"""
+    if "controllers" not in config:
+        fragment = {"modbus": next(iter(recommended.values()))}
+    else:
+        # The read planner's settings apply to all buses, so take those of the bus with
+        # the smallest blocks.
+        planner = min(recommended.values(), key=lambda settings: settings["max_block_size"])
+        fragment = {
+            "modbus": {key: planner[key] for key in ("max_block_size", "max_gap")},
+            "controllers": [
+                {"name": ctl.name, "modbus": {key: recommended[ctl.bus.name][key] for key in ("timeout", "request_delay")}}
+                for ctl in controllers if ctl.bus.name in recommended
+            ]
+        }
+    with open(path, "w") as f:
+        f.write(f"# Modbus settings measured by zity-mqtt-bridge.py tune on {time.strftime('%Y-%m-%d %H:%M')}.\n")
+        f.write("# Merge these into zity_config.yaml.\n")
+        yaml.safe_dump(fragment, f, sort_keys=False)
+
+def tune_buses(argv):
+    args = tune_arguments(argv)
+    if args.simulator:
+        start_tune_simulator()
+    recommended = {}
+    for bus in buses.values():
+        print(f"Bus {bus.name}")
+        print(f"{'block':>6} {'gap':>4} {'timeout':>8} {'delay':>7} {'reg/s':>8} {'cycle ms':>9} {'p50 ms':>7} {'p95 ms':>7} {'max ms':>7} {'errors':>7}")
+        results = []
+        for block_size, gap_size, timeout, delay in itertools.product(args.block_sizes, args.gaps, args.timeouts, args.delays):
+            result = measure_bus_settings(bus, block_size, gap_size, timeout, delay, args.cycles)
+            results.append(result)
+            print(
+                f"{block_size:>6} {gap_size:>4} {timeout:>8} {delay:>7} {result['throughput']:>8.1f} {result['cycle'] * 1000:>9.1f} "
+                f"{result['p50'] * 1000:>7.1f} {result['p95'] * 1000:>7.1f} {result['max'] * 1000:>7.1f} {result['error_rate']:>7.1%}"
+            )
+        settings = recommend_bus_settings(results, args.max_error_rate)
+        if settings is None:
+            print(f"Bus {bus.name}: no reliable settings found; check the wiring and the serial settings")
+            continue
+        print(f"Bus {bus.name}: recommended {settings}")
+        recommended[bus.name] = settings
+    if not recommended:
+        return 1
+    write_tune_fragment(args.output, recommended)
+    print(f"Wrote {args.output}")
+    return 0
 
 # ------------------ Start ------------------ #
-client = mqtt.Client()
+class BridgeClient(mqtt.Client):
+    """MQTT client that counts publishes for the metrics"""
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        inc_counter("zity_mqtt_publishes_total")
+        return super().publish(topic, payload, qos, retain, properties)
+
+def on_publish(client, userdata, mid):
+    inc_counter("zity_mqtt_published_total")
+    message_sent()
+
+def mqtt_inflight():
+    with outbound_lock:
+        return outbound_inflight
+
+metric_gauges["zity_mqtt_inflight"] = mqtt_inflight
+
+client = BridgeClient()
 client.username_pw_set(config["mqtt"]["username"], config["mqtt"]["password"])
 client.on_connect = on_connect
 client.on_message = on_message
-client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], 60)
+client.on_publish = on_publish
 
-mb.connect()
-threading.Thread(target=poll_zone_status, daemon=True).start()
+if sys.argv[1:2] == ["tune"]:
+    sys.exit(tune_buses(sys.argv[2:]))
 
-while True:
-    try:
-        client.loop_forever()
-    except Exception as e:
-        logger.error(f"MQTT connection lost: {e}. Reconnecting in 5s...")
-        time.sleep(5)
-        
+load_state_snapshot()
+
+if config.get("metrics", {}).get("port"):
+    start_metrics_server(config["metrics"]["port"])
+
+if runtime == "asyncio":
+    asyncio.run(async_main())
+else:
+    client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], 60)
+
+    for bus in buses.values():
+        bus.client.connect()
+        threading.Thread(target=bus_worker, args=(bus,), daemon=True).start()
+    for ctl in controllers:
+        threading.Thread(target=poll_zone_status, args=(ctl,), daemon=True).start()
+    threading.Thread(target=publish_worker, daemon=True).start()
+    if replay is not None:
+        threading.Thread(target=replay_commands, daemon=True).start()
+
+    while True:
+        try:
+            client.loop_forever()
+        except Exception as e:
+            logger.error(f"MQTT connection lost: {e}. Reconnecting in 5s...")
+            time.sleep(5)
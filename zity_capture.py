@@ -0,0 +1,386 @@
+"""Capture and replay of the bridge's Modbus traffic and MQTT commands.
+
+With a capture file configured, the bridge wraps its Modbus clients in a recording
+client that appends every request and its response to a compact binary capture file,
+together with every MQTT command it receives. The file is rotated when it grows too
+large. A capture can be replayed through the bridge later, without the controller: the
+replay client answers reads with the register values the controller reported at that
+point in the capture, with the recorded latencies and errors, and the recorded commands
+are fed to the bridge at their original times. Replays can run faster than real time.
+
+    python zity-benchmark.py --replay zity-capture.bin [--speed 10]
+
+replays a capture against the MQTT broker stand-in and reports the bridge's CPU time
+and MQTT traffic.
+"""
+import asyncio
+import bisect
+import os
+import struct
+import threading
+import time
+
+from pymodbus import exceptions as modbus_exceptions
+
+MAGIC = b"ZITYCAP1"
+
+MODBUS_RECORD = 1
+MESSAGE_RECORD = 2
+
+# Every record starts with its kind and the wall clock time.
+RECORD_HEADER = struct.Struct(">Bd")
+# latency, slave, function code, address, count, status, number of values
+MODBUS_HEADER = struct.Struct(">fBBHHBH")
+# topic length, payload length
+MESSAGE_HEADER = struct.Struct(">HI")
+ERROR_LENGTH = struct.Struct(">H")
+
+READ_INPUT_REGISTERS = 4
+READ_HOLDING_REGISTERS = 3
+WRITE_REGISTERS = 16
+
+# The status of a recorded transaction: answered, answered with an error response, or
+# failed with an exception such as a timeout. The error text of an exception starts with
+# its class name, like "ConnectionException: ...", so a replay raises the same pymodbus
+# exception and the bridge takes the same path, like reconnecting after a lost
+# connection.
+OK = 0
+ERROR_RESPONSE = 1
+EXCEPTION = 2
+
+# ------------------ Capture files ------------------ #
+
+class CaptureWriter:
+    """Appends records to a capture file, rotating it at max_bytes.
+
+    Like logging's RotatingFileHandler, the full file is renamed to path.1, path.1 to
+    path.2 and so on, keeping at most backups old files. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, path, max_bytes=10_000_000, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, data):
+        with self.lock:
+            if self.file.tell() + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+
+    def record_modbus(self, slave, function, address, count, values, latency, status=OK, error=None):
+        data = RECORD_HEADER.pack(MODBUS_RECORD, time.time()) + MODBUS_HEADER.pack(
+            latency, slave, function, address, count, status, len(values)
+        ) + struct.pack(f">{len(values)}H", *values)
+        if status != OK:
+            text = (error or "").encode()[:1000]
+            data += ERROR_LENGTH.pack(len(text)) + text
+        self.write(data)
+
+    def record_message(self, topic, payload):
+        topic = topic.encode()
+        payload = payload.encode() if isinstance(payload, str) else payload
+        self.write(
+            RECORD_HEADER.pack(MESSAGE_RECORD, time.time()) + MESSAGE_HEADER.pack(len(topic), len(payload)) + topic + payload
+        )
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def capture_files(path):
+    """The files of a capture, oldest first, including rotated ones"""
+    rotated = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        rotated.append(f"{path}.{index}")
+        index += 1
+    return list(reversed(rotated)) + ([path] if os.path.exists(path) else [])
+
+def read_capture(path):
+    """Yield the records of a capture file as dicts; a truncated last record is ignored"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a Zity capture file")
+    offset = len(MAGIC)
+    try:
+        while offset < len(data):
+            kind, at = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if kind == MODBUS_RECORD:
+                latency, slave, function, address, count, status, length = MODBUS_HEADER.unpack_from(data, offset)
+                offset += MODBUS_HEADER.size
+                values = struct.unpack_from(f">{length}H", data, offset)
+                offset += 2 * length
+                error = None
+                if status != OK:
+                    (error_length,) = ERROR_LENGTH.unpack_from(data, offset)
+                    offset += ERROR_LENGTH.size
+                    error = data[offset:offset + error_length].decode(errors="replace")
+                    offset += error_length
+                yield {
+                    "kind": "modbus", "time": at, "latency": latency, "slave": slave, "function": function,
+                    "address": address, "count": count, "status": status, "values": values, "error": error
+                }
+            elif kind == MESSAGE_RECORD:
+                topic_length, payload_length = MESSAGE_HEADER.unpack_from(data, offset)
+                offset += MESSAGE_HEADER.size
+                if offset + topic_length + payload_length > len(data):
+                    return
+                topic = data[offset:offset + topic_length].decode()
+                offset += topic_length
+                payload = data[offset:offset + payload_length]
+                offset += payload_length
+                yield {"kind": "message", "time": at, "topic": topic, "payload": payload}
+            else:
+                raise ValueError(f"{path}: unknown record kind {kind} at offset {offset}")
+    except struct.error:
+        # The bridge was stopped in the middle of writing a record.
+        return
+
+# ------------------ Recording ------------------ #
+
+class RecordingClient:
+    """Wraps a pymodbus client and records every register read and write"""
+
+    def __init__(self, client, writer):
+        self.client = client
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def read_input_registers(self, address, count, slave=0):
+        return self.call(READ_INPUT_REGISTERS, self.client.read_input_registers, address, count, slave)
+
+    def read_holding_registers(self, address, count, slave=0):
+        return self.call(READ_HOLDING_REGISTERS, self.client.read_holding_registers, address, count, slave)
+
+    def write_registers(self, address, values, slave=0):
+        return self.call(WRITE_REGISTERS, self.client.write_registers, address, values, slave)
+
+    def call(self, function, method, address, argument, slave):
+        started = time.monotonic()
+        try:
+            result = method(address, argument, slave=slave)
+        except Exception as e:
+            self.record(function, slave, address, argument, None, time.monotonic() - started, e)
+            raise
+        self.record(function, slave, address, argument, result, time.monotonic() - started)
+        return result
+
+    def record(self, function, slave, address, argument, result, latency, exception=None):
+        # Writes record the values written, reads the values read.
+        count, values = (len(argument), list(argument)) if function == WRITE_REGISTERS else (argument, [])
+        if exception is not None:
+            status, error = EXCEPTION, f"{type(exception).__name__}: {exception}"
+        elif result.isError():
+            status, error = ERROR_RESPONSE, str(result)
+        else:
+            status, error = OK, None
+            if function != WRITE_REGISTERS:
+                values = result.registers
+        self.writer.record_modbus(slave, function, address, count, values, latency, status, error)
+
+class AsyncRecordingClient(RecordingClient):
+    """RecordingClient for pymodbus's async clients"""
+
+    async def call(self, function, method, address, argument, slave):
+        started = time.monotonic()
+        try:
+            result = await method(address, argument, slave=slave)
+        except Exception as e:
+            self.record(function, slave, address, argument, None, time.monotonic() - started, e)
+            raise
+        self.record(function, slave, address, argument, result, time.monotonic() - started)
+        return result
+
+# ------------------ Replay ------------------ #
+
+class Replay:
+    """A capture indexed for replay: register values, outcomes and commands over time.
+
+    The replay clock runs speed times as fast as the wall clock, from the first record
+    of the capture once begin() is called.
+    """
+
+    def __init__(self, records, speed=1.0):
+        self.speed = speed
+        # (slave, function, address) -> (times, values); reads of either table
+        self.images = {}
+        # (slave, function, address, count) -> (times, (status, error, latency))
+        self.outcomes = {}
+        self.messages = []
+        self.start = None
+        self.end = None
+        self.started = None
+        for record in records:
+            self.start = record["time"] if self.start is None else self.start
+            self.end = record["time"]
+            if record["kind"] == "message":
+                self.messages.append((record["time"], record["topic"], record["payload"]))
+                continue
+            key = (record["slave"], record["function"], record["address"], record["count"])
+            times, outcomes = self.outcomes.setdefault(key, ([], []))
+            times.append(record["time"])
+            outcomes.append((record["status"], record["error"], record["latency"]))
+            if record["function"] != WRITE_REGISTERS and record["status"] == OK:
+                for offset, value in enumerate(record["values"]):
+                    times, values = self.images.setdefault((record["slave"], record["function"], record["address"] + offset), ([], []))
+                    times.append(record["time"])
+                    values.append(value)
+        if self.start is None:
+            raise ValueError("The capture is empty")
+
+    @classmethod
+    def load(cls, path, speed=1.0):
+        records = []
+        for name in capture_files(path):
+            records.extend(read_capture(name))
+        return cls(records, speed)
+
+    def begin(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def now(self):
+        """The current time in the capture"""
+        return self.start + (time.monotonic() - self.started) * self.speed
+
+    def wall_delay(self, at):
+        """Wall clock seconds until the replay reaches capture time at"""
+        return max(0.0, (at - self.now()) / self.speed)
+
+    def finished(self):
+        return self.now() >= self.end
+
+    @staticmethod
+    def latest(times, items, at):
+        """The item recorded last at or before at, or the first one"""
+        return items[max(0, bisect.bisect_right(times, at) - 1)]
+
+    def respond(self, slave, function, address, argument):
+        """Return (latency, response) for a request, as the controller answered at this time"""
+        now = self.now()
+        count = len(argument) if function == WRITE_REGISTERS else argument
+        outcome = self.outcomes.get((slave, function, address, count))
+        latency = 0.0
+        if outcome is not None:
+            status, error, latency = self.latest(*outcome, now)
+            if status == EXCEPTION:
+                return latency, replayed_exception(error)
+            if status == ERROR_RESPONSE:
+                return latency, ReplayResponse(error=error)
+        if function == WRITE_REGISTERS:
+            return latency, ReplayResponse()
+        registers = []
+        for register in range(address, address + count):
+            image = self.images.get((slave, function, register))
+            if image is None:
+                return latency, ReplayResponse(error=f"register {register} is not in the capture")
+            registers.append(self.latest(*image, now))
+        return latency, ReplayResponse(registers)
+
+class ReplayException(Exception):
+    """A recorded exception, like a timeout, raised again during a replay"""
+
+def replayed_exception(error):
+    """The exception to raise for a recorded one: the same pymodbus exception if it was one"""
+    name, _, text = error.partition(": ")
+    exception_class = getattr(modbus_exceptions, name, None) if name.isidentifier() else None
+    if not (isinstance(exception_class, type) and issubclass(exception_class, modbus_exceptions.ModbusException)):
+        # Not a pymodbus exception, or captured before class names were recorded.
+        return ReplayException(error)
+    exception = exception_class.__new__(exception_class)
+    # Without the constructor's decoration, the message reads exactly as recorded.
+    modbus_exceptions.ModbusException.__init__(exception, text.removeprefix("Modbus Error: "))
+    return exception
+
+class ReplayResponse:
+    """Stands in for a pymodbus response"""
+
+    def __init__(self, registers=None, error=None):
+        self.registers = registers or []
+        self.error = error
+
+    def isError(self):
+        return self.error is not None
+
+    def __str__(self):
+        return self.error or f"ReplayResponse({self.registers})"
+
+class ReplayClient:
+    """Stands in for a pymodbus client, answering from a Replay"""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.connected = False
+
+    def connect(self):
+        self.replay.begin()
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def lose_connection(self, exception):
+        """Drop the connection when replaying a lost one, so the bridge reconnects"""
+        if isinstance(exception, modbus_exceptions.ConnectionException):
+            self.connected = False
+
+    def request(self, function, address, argument, slave):
+        latency, response = self.replay.respond(slave, function, address, argument)
+        time.sleep(latency / self.replay.speed)
+        if isinstance(response, Exception):
+            self.lose_connection(response)
+            raise response
+        return response
+
+    def read_input_registers(self, address, count, slave=0):
+        return self.request(READ_INPUT_REGISTERS, address, count, slave)
+
+    def read_holding_registers(self, address, count, slave=0):
+        return self.request(READ_HOLDING_REGISTERS, address, count, slave)
+
+    def write_registers(self, address, values, slave=0):
+        return self.request(WRITE_REGISTERS, address, values, slave)
+
+class AsyncReplayClient(ReplayClient):
+    """ReplayClient for the bridge's asyncio runtime"""
+
+    async def connect(self):
+        return super().connect()
+
+    async def request(self, function, address, argument, slave):
+        latency, response = self.replay.respond(slave, function, address, argument)
+        await asyncio.sleep(latency / self.replay.speed)
+        if isinstance(response, Exception):
+            self.lose_connection(response)
+            raise response
+        return response
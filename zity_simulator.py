@@ -0,0 +1,453 @@
+"""Zity controller simulator and MQTT broker stand-in.
+
+Serves a simulated Zity 2.0 controller as a Modbus RTU slave on a pseudo terminal, and
+optionally behind a simulated Modbus TCP or RTU-over-TCP gateway, together with a
+minimal MQTT broker, so the bridge can be run, tested and benchmarked without the
+physical controller. The register map is taken from zity_config.yaml.
+
+Run it on its own with:
+
+    python zity_simulator.py [--config zity_config.yaml] [--mqtt-port 1883]
+
+It prints the pty path to use as the modbus port in the bridge configuration. The
+benchmark (zity-benchmark.py) imports it to run everything in one process.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import struct
+import time
+import tty
+
+import yaml
+
+logger = logging.getLogger("zity_simulator")
+
+# ------------------ Modbus RTU framing ------------------ #
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack("<H", crc)
+
+def request_length(buffer):
+    """Length of the request frame at the start of buffer, or None if not known yet"""
+    if len(buffer) < 2:
+        return None
+    if buffer[1] == 16:
+        if len(buffer) < 7:
+            return None
+        return 9 + buffer[6]
+    # Read holding/input registers and write single register requests are all 8 bytes.
+    return 8
+
+# ------------------ Zity controller ------------------ #
+
+# Write registers of a zone and the input register that reflects them.
+ZONE_WRITE_TO_READ = {
+    "setpoint_write_register": "setpoint_read_register",
+    "status_write_register": "status_read_register",
+    "fan_mode_write_register": "fan_mode_read_register",
+    "preset_mode_write_register": "preset_mode_read_register"
+}
+
+class Zity:
+    """Register map and behaviour of a simulated Zity controller.
+
+    Writes are only accepted after a write to the trigger register, and not before
+    trigger_settle seconds have passed since then. An accepted write to a write register
+    shows up in the corresponding input register after propagation_delay seconds.
+    Response timing follows the configured baudrate. Reads that include a register in
+    dead_registers get no response at all, like those of a zone whose thermostat is
+    offline.
+
+    Listeners are called with (register, value) for every accepted write. Transaction
+    listeners are called by serve_pty with the time a request arrived, the request and
+    the time the transaction occupies the bus.
+    """
+
+    def __init__(self, config, baudrate=None, propagation_delay=1.0, trigger_settle=0.0,
+                 trigger_timeout=10.0, strict_gaps=False, temp_drift=0.0):
+        self.slave_id = config["modbus"]["slave_id"]
+        self.baudrate = baudrate or config["modbus"]["baudrate"]
+        self.propagation_delay = propagation_delay
+        self.trigger_settle = trigger_settle
+        self.trigger_timeout = trigger_timeout
+        self.strict_gaps = strict_gaps
+        self.temp_drift = temp_drift
+        self.trigger_register = config["trigger_register"]
+        self.input_registers = {}
+        self.holding_registers = {self.trigger_register: 0}
+        self.write_to_read = {}
+        self.temp_registers = []
+        self.pending = []
+        self.trigger_time = None
+        self.dead_registers = set()
+        self.listeners = []
+        self.transaction_listeners = []
+        self.stats = {"transactions": 0, "reads": 0, "writes": 0, "ignored_writes": 0, "exceptions": 0}
+
+        for zone in config["zones"].values():
+            self.input_registers[zone["temp_read_register"]] = 215
+            self.input_registers[zone["setpoint_read_register"]] = 220
+            self.input_registers[zone["status_read_register"]] = 1
+            self.input_registers[zone["damper_status_read_register"]] = 1
+            self.input_registers[zone["fan_mode_read_register"]] = 0
+            self.input_registers[zone["preset_mode_read_register"]] = 0
+            self.temp_registers.append(zone["temp_read_register"])
+            for write_key, read_key in ZONE_WRITE_TO_READ.items():
+                self.write_to_read[zone[write_key]] = zone[read_key]
+                self.holding_registers[zone[write_key]] = self.input_registers[zone[read_key]]
+            self.holding_registers[zone["master_slave_register"]] = 0
+            self.holding_registers[zone["fan_control_register"]] = 0
+
+        system = config["system_registers"]
+        self.input_registers.update({
+            system["mode"]: 3,
+            system["power_mode"]: 1,
+            system["controller_mode"]: 1,
+            system["setpoint"]: 22,
+            system["fan_speed"]: 2,
+            system["flexifan_speed"]: 2,
+            system["return_temp"]: 240
+        })
+        self.write_to_read[system["mode_write"]] = system["mode"]
+        self.write_to_read[system["power_mode_write"]] = system["power_mode"]
+        self.holding_registers[system["mode_write"]] = 3
+        self.holding_registers[system["power_mode_write"]] = 1
+        for reg in config["alarm_registers"]:
+            self.input_registers[int(reg)] = 0
+
+    def transaction_time(self, request_bytes, response_bytes):
+        """Time the bus is busy for one transaction: both frames plus inter-frame silence"""
+        character_time = 11 / self.baudrate
+        return (request_bytes + response_bytes + 7) * character_time
+
+    def apply_pending_writes(self):
+        now = time.monotonic()
+        for item in [item for item in self.pending if item[0] <= now]:
+            self.input_registers[item[1]] = item[2]
+            self.pending.remove(item)
+
+    def write(self, address, values):
+        now = time.monotonic()
+        for offset, value in enumerate(values):
+            register = address + offset
+            if register == self.trigger_register:
+                self.trigger_time = now
+                self.holding_registers[register] = value
+                continue
+            if (self.trigger_time is None or now - self.trigger_time < self.trigger_settle
+                    or now - self.trigger_time > self.trigger_timeout):
+                self.stats["ignored_writes"] += 1
+                continue
+            self.holding_registers[register] = value
+            for listener in self.listeners:
+                listener(register, value)
+            if register in self.write_to_read:
+                self.pending.append((now + self.propagation_delay, self.write_to_read[register], value))
+
+    def exception(self, function_code, code):
+        self.stats["exceptions"] += 1
+        return bytes([self.slave_id, function_code | 0x80, code])
+
+    def handle(self, frame):
+        """Handle a request frame without its CRC and return the response, or None"""
+        if frame[0] != self.slave_id:
+            return None
+        self.stats["transactions"] += 1
+        self.apply_pending_writes()
+        if self.temp_drift and random.random() < self.temp_drift:
+            register = random.choice(self.temp_registers)
+            self.input_registers[register] += random.choice((-1, 1))
+
+        function_code = frame[1]
+        if function_code in (3, 4):
+            self.stats["reads"] += 1
+            address, count = struct.unpack(">HH", frame[2:6])
+            table = self.input_registers if function_code == 4 else self.holding_registers
+            addresses = range(address, address + count)
+            if self.dead_registers.intersection(addresses):
+                return None
+            if any(a not in table for a in addresses) and (count == 1 or self.strict_gaps):
+                return self.exception(function_code, 2)
+            values = [table.get(a, 0) for a in addresses]
+            return bytes([self.slave_id, function_code, 2 * count]) + struct.pack(f">{count}H", *values)
+        if function_code == 6:
+            self.stats["writes"] += 1
+            address, value = struct.unpack(">HH", frame[2:6])
+            self.write(address, [value])
+            return frame[:6]
+        if function_code == 16:
+            self.stats["writes"] += 1
+            address, count, byte_count = struct.unpack(">HHB", frame[2:7])
+            self.write(address, list(struct.unpack(f">{count}H", frame[7:7 + byte_count])))
+            return frame[:6]
+        return self.exception(function_code, 1)
+
+def serve_pty(zity, loop):
+    """Serve the simulated controller on a new pseudo terminal and return its path"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    buffer = bytearray()
+
+    def on_readable():
+        buffer.extend(os.read(master, 1024))
+        while True:
+            length = request_length(buffer)
+            if length is None or len(buffer) < length:
+                return
+            frame = bytes(buffer[:length])
+            del buffer[:length]
+            if crc16(frame[:-2]) != frame[-2:]:
+                logger.warning("CRC error; discarding input")
+                buffer.clear()
+                return
+            received = time.monotonic()
+            response = zity.handle(frame[:-2])
+            if response is None:
+                continue
+            response += crc16(response)
+            # Answer when the request and the response would have crossed the wire.
+            duration = zity.transaction_time(len(frame), len(response))
+            loop.call_later(duration, os.write, master, response)
+            for listener in zity.transaction_listeners:
+                listener(received, frame, duration)
+
+    loop.add_reader(master, on_readable)
+    # Keep our end of the slave side open, so the pty survives the bridge reconnecting.
+    return os.ttyname(slave)
+
+async def serve_tcp(zity, host="127.0.0.1", port=0, framing="tcp"):
+    """Serve the simulated controller behind a simulated Ethernet gateway.
+
+    framing is "tcp" for Modbus TCP (MBAP header, any number of requests in flight) or
+    "rtu" for RTU frames passed through the socket. Like a real gateway, requests are
+    put on the simulated RS485 bus one after another. Returns the port it listens on.
+    """
+    loop = asyncio.get_running_loop()
+    bus_free = [0.0]
+
+    def respond(writer, received, frame, response):
+        # The gateway answers when the transaction has crossed the RS485 bus.
+        duration = zity.transaction_time(len(frame) + 2, len(response) + 2)
+        start = max(received, bus_free[0])
+        bus_free[0] = start + duration
+        loop.call_later(bus_free[0] - time.monotonic(), writer.write, response)
+        for listener in zity.transaction_listeners:
+            listener(start, frame, duration)
+
+    async def handle_client(reader, writer):
+        buffer = bytearray()
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                writer.close()
+                return
+            buffer.extend(data)
+            while True:
+                received = time.monotonic()
+                if framing == "tcp":
+                    if len(buffer) < 7:
+                        break
+                    length = struct.unpack(">H", buffer[4:6])[0]
+                    if len(buffer) < 6 + length:
+                        break
+                    header, frame = bytes(buffer[:6]), bytes(buffer[6:6 + length])
+                    del buffer[:6 + length]
+                    response = zity.handle(frame)
+                    if response is not None:
+                        respond(writer, received, frame, header[:4] + struct.pack(">H", len(response)) + response)
+                else:
+                    length = request_length(buffer)
+                    if length is None or len(buffer) < length:
+                        break
+                    frame = bytes(buffer[:length])
+                    del buffer[:length]
+                    if crc16(frame[:-2]) != frame[-2:]:
+                        logger.warning("CRC error; discarding input")
+                        buffer.clear()
+                        break
+                    response = zity.handle(frame[:-2])
+                    if response is not None:
+                        respond(writer, received, frame[:-2], response + crc16(response))
+
+    server = await asyncio.start_server(handle_client, host, port)
+    return server.sockets[0].getsockname()[1]
+
+# ------------------ MQTT broker stand-in ------------------ #
+
+def topic_matches(pattern, topic):
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts) or (part != "+" and part != topic_parts[index]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+def encode_string(value):
+    return struct.pack(">H", len(value)) + value
+
+class Broker:
+    """A minimal MQTT 3.1.1 broker: QoS 0 and 1, retained messages and wildcards.
+
+    There is no authentication and no persistence. Listeners are called with the topic
+    and payload of every published message.
+    """
+
+    def __init__(self):
+        self.retained = {}
+        self.sessions = []
+        self.listeners = []
+        self.stats = {"publishes": 0, "retained_writes": 0}
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def deliver(self, topic, payload, retain):
+        self.stats["publishes"] += 1
+        if retain:
+            self.stats["retained_writes"] += 1
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for listener in self.listeners:
+            listener(topic, payload)
+        for session in self.sessions:
+            if any(topic_matches(pattern, topic) for pattern in session.subscriptions):
+                session.send_publish(topic, payload, False)
+
+    async def handle_connection(self, reader, writer):
+        session = BrokerSession(self, writer)
+        self.sessions.append(session)
+        try:
+            while True:
+                first = (await reader.readexactly(1))[0]
+                multiplier, length = 1, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                if not session.handle_packet(first, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.remove(session)
+            writer.close()
+
+class BrokerSession:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions = set()
+
+    def send(self, first, body):
+        self.writer.write(bytes([first]) + encode_length(len(body)) + body)
+
+    def send_publish(self, topic, payload, retain):
+        self.send(0x30 | retain, encode_string(topic.encode()) + payload)
+
+    def handle_packet(self, first, body):
+        packet_type = first >> 4
+        if packet_type == 1:  # CONNECT
+            self.send(0x20, b"\x00\x00")
+        elif packet_type == 3:  # PUBLISH
+            qos = (first >> 1) & 3
+            topic_length = struct.unpack(">H", body[:2])[0]
+            topic = body[2:2 + topic_length].decode()
+            position = 2 + topic_length
+            if qos:
+                packet_id = body[position:position + 2]
+                position += 2
+                self.send(0x40 if qos == 1 else 0x50, packet_id)
+            self.broker.deliver(topic, body[position:], first & 1)
+        elif packet_type == 6:  # PUBREL
+            self.send(0x70, body[:2])
+        elif packet_type == 8:  # SUBSCRIBE
+            packet_id, position, patterns = body[:2], 2, []
+            while position < len(body):
+                length = struct.unpack(">H", body[position:position + 2])[0]
+                patterns.append(body[position + 2:position + 2 + length].decode())
+                position += 3 + length
+            self.subscriptions.update(patterns)
+            self.send(0x90, packet_id + bytes(len(patterns)))
+            for topic, payload in list(self.broker.retained.items()):
+                if any(topic_matches(pattern, topic) for pattern in patterns):
+                    self.send_publish(topic, payload, 1)
+        elif packet_type == 10:  # UNSUBSCRIBE
+            packet_id, position = body[:2], 2
+            while position < len(body):
+                length = struct.unpack(">H", body[position:position + 2])[0]
+                self.subscriptions.discard(body[position + 2:position + 2 + length].decode())
+                position += 2 + length
+            self.send(0xB0, packet_id)
+        elif packet_type == 12:  # PINGREQ
+            self.send(0xD0, b"")
+        elif packet_type == 14:  # DISCONNECT
+            return False
+        return True
+
+# ------------------ Main ------------------ #
+
+async def main():
+    parser = argparse.ArgumentParser(description="Zity controller simulator and MQTT broker stand-in")
+    parser.add_argument("--config", default="zity_config.yaml")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--baudrate", type=int, help="defaults to the baudrate in the config")
+    parser.add_argument("--propagation-delay", type=float, default=1.0,
+                        help="seconds before a write shows up in the read register")
+    parser.add_argument("--trigger-settle", type=float, default=0.0,
+                        help="writes sooner than this after a trigger write are ignored")
+    parser.add_argument("--strict-gaps", action="store_true",
+                        help="refuse block reads that include unknown registers")
+    parser.add_argument("--temp-drift", type=float, default=0.05,
+                        help="chance per transaction that a zone temperature changes")
+    parser.add_argument("--dead-register", type=int, action="append", default=[],
+                        help="never answer reads of this register; can be repeated")
+    parser.add_argument("--tcp-port", type=int, help="also serve Modbus TCP on this port")
+    parser.add_argument("--rtu-over-tcp-port", type=int, help="also serve RTU over TCP on this port")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    loop = asyncio.get_running_loop()
+    zity = Zity(config, args.baudrate, args.propagation_delay, args.trigger_settle,
+                strict_gaps=args.strict_gaps, temp_drift=args.temp_drift)
+    zity.dead_registers.update(args.dead_register)
+    broker = Broker()
+    port = await broker.start("0.0.0.0", args.mqtt_port)
+    logger.info(f"Zity simulator on {serve_pty(zity, loop)}, MQTT broker on port {port}")
+    if args.tcp_port:
+        logger.info(f"Modbus TCP on port {await serve_tcp(zity, '0.0.0.0', args.tcp_port)}")
+    if args.rtu_over_tcp_port:
+        logger.info(f"RTU over TCP on port {await serve_tcp(zity, '0.0.0.0', args.rtu_over_tcp_port, 'rtu')}")
+    while True:
+        await asyncio.sleep(60)
+        logger.info(f"Modbus: {zity.stats}, MQTT: {broker.stats}")
+
+if __name__ == "__main__":
+    asyncio.run(main())